@@ -1,8 +1,18 @@
 #!/usr/bin/env python
-import sys,os,time,numpy as np,pyrap,matplotlib
+import sys,os,time,hashlib,tempfile,numpy as np,pyrap,matplotlib
 matplotlib.use('Agg')
 from pyrap import tables as pt
 from matplotlib import pyplot as plt
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from task_scheduler import schedule
+from results_store import put_result
+from ms_meta import ms_antenna_names
+
+BLOCKROWS = 10000    # rows read per getcol when streaming a baseline
+# persistent cache of per-triangle closure phases and statistics
+CACHE_DIR = os.environ.get('CLOSURE_CACHE_DIR',\
+            os.path.join(os.path.expanduser('~'),'.cache','closure_v4'))
+CACHE_MAXBYTES = int(os.environ.get('CLOSURE_CACHE_MAXBYTES',500*1024**2))
 
 #  closure.py v1  Neal Jackson 2017 Jan 4
 # Given a visibility file, return the scatter on the closure phases for a
@@ -41,6 +51,11 @@ from matplotlib import pyplot as plt
 #    doplot: if True produce plot of the closure phases
 #    doret: if True return a list of closure phase arrays in the order
 #           requested in the tel input
+#    inprocess: if True read the triangle baselines directly from the MS
+#           with casacore, without running taql or writing temporary MSs
+#    usecache: if True (and inprocess) keep/reuse results in the closure
+#           cache (CLOSURE_CACHE_DIR, default ~/.cache/closure_v4)
+#    scratch: directory for the temporary files of the taql version
 #
 #  returns:
 #  Most general case, dopipe=False,doret=True: will return a list, one 
@@ -48,7 +63,8 @@ from matplotlib import pyplot as plt
 #  scatter, followed (if doret) by numpy arrays of closure phases
 
 def closure(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
-            doplot=False,doret=False):
+            doplot=False,doret=False,inprocess=False,usecache=True,\
+            scratch='.'):
 
     # Find target source id
 
@@ -56,12 +72,192 @@ def closure(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
     print "target_id", target_id
     print "Antennas for closure phase", tel
 
-    # Find array of requested telescopes and list of telescopes in data
+    if inprocess:
+        clstats,allcp = closure_inprocess(vis,tel,lastv=lastv,pol=pol,\
+                             use_spw=use_spw,bchan=bchan,echan=echan,\
+                             usecache=usecache)
+    else:
+        clstats,allcp = closure_taql(vis,tel,lastv=lastv,pol=pol,\
+                             use_spw=use_spw,bchan=bchan,echan=echan,\
+                             scratch=scratch)
+    if doplot:
+        cl_mkplot (allcp,tel,target_id)
+    clstats = clstats[0] if len(clstats)==1 else clstats
+    if doret:
+        return clstats,allcp
+    else:
+        return clstats
+
+# For each requested telescope, determine its position in the list
+# If more than one telescope in the list match to within the number
+#   of letters in the requested telescope, keep the first (so CS002
+#   will match to CS002HBA0 and CS002HBA1 will be ignored)
+# Telescopes not found get index -1
+
+def match_tels(atel,idxtel):
+    aidx = -np.ones(len(atel),dtype='int')
+    for i in range(len(atel)):
+        for j in range(len(idxtel)):
+            if atel[i]==idxtel[j][:len(atel[i])]:
+                aidx[i] = j
+                break
+    return aidx
+
+# Antenna names of a MS, from the ANTENNA table via the metadata cache. If
+# the NAME column is just numbers (e.g. written by AIPS) the STATION column.
+
+def get_antenna_names(vis):
+    return ms_antenna_names(vis)
+
+# In-process closure engine. The MS is opened once with casacore and
+# ANTENNA1/ANTENNA2/TIME/DATA_DESC_ID are read by column. Every baseline
+# needed by any of the requested triangles is read once, through row-number
+# index arrays, into a baseline x time matrix of channel sums. The closure
+# phases of all triangles then come from that matrix by index arithmetic,
+# so the cost grows with the number of baselines, not triangles. No
+# temporary measurement sets are written. Returns the same statistics and
+# closure phases as closure_taql. Results are kept in the closure cache, so
+# repeated calls on an unchanged MS do not read the data again.
+
+def closure_inprocess(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
+                      usecache=True):
+    idxtel = get_antenna_names(vis)
+    nant = len(idxtel)
+    atel = np.unique(np.ravel(tel))
+    aidx = match_tels(atel,idxtel)
+    if (aidx==-1).any():
+        print 'The following telescopes were not found:',list(atel[aidx==-1])
+
+    # antenna numbers of each triangle (-1 if missing) and the baselines
+    # 0-1, 1-2, 0-2 of each one, coded as ANTENNA1*nant+ANTENNA2
+    tri = np.sort(aidx[np.searchsorted(atel,np.asarray(tel))],axis=1)
+    ok = tri[:,0]>=0
+    trikey = np.array([tri[ok,0]*nant+tri[ok,1],tri[ok,1]*nant+tri[ok,2],\
+                       tri[ok,0]*nant+tri[ok,2]]).T
+
+    # triangles already in the cache need not be read again
+    clstats,allcp = np.ones(len(tri))*np.nan,[np.array([])]*len(tri)
+    stamp = ms_stamp(vis)
+    keys = [cache_key(vis,tri[i],pol,use_spw,bchan,echan,lastv,stamp=stamp) \
+            for i in range(len(tri))]
+    todo = np.copy(ok)
+    for i in np.argwhere(ok)[:,0]:
+        hit = cache_get(keys[i]) if usecache else None
+        if hit is not None:
+            clstats[i],allcp[i] = hit
+            todo[i] = False
+    if not todo.any():
+        return clstats,allcp
+    trikey = trikey[todo[ok]]
+    blkeys,blidx = np.unique(trikey,return_inverse=True)
+    blidx = blidx.reshape(-1,3)
+
+    t = pt.table(vis,ack=False)
+    rowkey = t.getcol('ANTENNA1')*nant+t.getcol('ANTENNA2')
+    timecol,spwcol = t.getcol('TIME'),t.getcol('DATA_DESC_ID')
+    order = np.argsort(rowkey,kind='mergesort')   # keeps time order
+    lo = np.searchsorted(rowkey[order],blkeys,side='left')
+    hi = np.searchsorted(rowkey[order],blkeys,side='right')
+    rows = [order[lo[i]:hi[i]][:lastv] for i in range(len(blkeys))]
+    rows = [r[spwcol[r]==use_spw] for r in rows]
+    times = np.unique(np.concatenate([timecol[r] for r in rows]+[[]]))
+    blsum = np.ones((len(blkeys),len(times)),dtype='complex')*np.nan
+    for i in range(len(blkeys)):
+        for blk in baseline_blocks(t.selectrows(rows[i]),['TIME','DATA']):
+            blsum[i,np.searchsorted(times,blk['TIME'])] = \
+                 chan_sum(blk['DATA'],pol=pol,bchan=bchan,echan=echan)
+    t.close()
+
+    triph = closure_phasors(blsum[blidx[:,0]],blsum[blidx[:,1]],\
+                            blsum[blidx[:,2]])
+    for i,itri in enumerate(np.argwhere(todo)[:,0]):
+        allcp[itri] = triph[i][~np.isnan(triph[i])]
+        if len(allcp[itri]):
+            clstats[itri] = clph_stat(allcp[itri])
+        if usecache:
+            cache_put(keys[itri],clstats[itri],allcp[itri])
+    return clstats,allcp
+
+################## closure cache ########################
+# Closure phases per timestamp and the closure statistic of a triangle are
+# kept in CACHE_DIR as one .npz per key. The key covers the MS path and
+# its modification stamp, so rewriting the MS invalidates the entry. Least
+# recently used entries are removed when the cache exceeds CACHE_MAXBYTES.
+
+# Modification stamp of a MS: newest mtime and total size of the files of
+# the main table (the lock file changes on every open, so it is left out)
+def ms_stamp(vis):
+    mtime,size = 0.0,0
+    for f in os.listdir(vis):
+        if f=='table.lock' or not os.path.isfile(os.path.join(vis,f)):
+            continue
+        st = os.stat(os.path.join(vis,f))
+        mtime,size = max(mtime,st.st_mtime),size+st.st_size
+    return '%.6f:%d'%(mtime,size)
+
+# Key for triangle tri (antenna numbers) of vis with the given selection;
+# stat names the statistic stored with the closure phases
+def cache_key(vis,tri,pol,use_spw,bchan,echan,lastv,stat='clph_stat',stamp=None):
+    stamp = ms_stamp(vis) if stamp is None else stamp
+    key = '%s|%s|%s|%d|%s|%d|%d|%d|%s' % (os.path.abspath(vis),stamp,\
+          ','.join([str(i) for i in tri]),pol,use_spw,bchan,echan,lastv,stat)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+# Returns (statistic, closure phases) or None if not cached
+def cache_get(key):
+    fname = os.path.join(CACHE_DIR,key+'.npz')
+    try:
+        f = np.load(fname)
+        hit = float(f['stat']),f['clph']
+        f.close()
+    except (IOError,OSError,KeyError,ValueError):
+        return None
+    os.utime(fname,None)    # mark as recently used
+    return hit
+
+def cache_put(key,stat,clph):
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        fd,tmpname = tempfile.mkstemp(suffix='.npz',dir=CACHE_DIR)
+        with os.fdopen(fd,'wb') as f:
+            np.savez(f,stat=stat,clph=clph)
+        os.rename(tmpname,os.path.join(CACHE_DIR,key+'.npz'))
+        cache_evict()
+    except (IOError,OSError):
+        pass    # the cache is only an optimisation
 
-    command = 'taql \'select NAME from %s/ANTENNA\' >closure_txt'%vis
+def cache_evict(maxbytes=None):
+    maxbytes = CACHE_MAXBYTES if maxbytes is None else maxbytes
+    entries = []
+    for f in os.listdir(CACHE_DIR):
+        if f.endswith('.npz'):
+            st = os.stat(os.path.join(CACHE_DIR,f))
+            entries.append((st.st_mtime,st.st_size,f))
+    total = sum([e[1] for e in entries])
+    for mtime,size,f in sorted(entries):
+        if total <= maxbytes:
+            break
+        try:
+            os.remove(os.path.join(CACHE_DIR,f))
+            total -= size
+        except OSError:
+            pass
+
+# Original version: cut the required baselines out into cl_temp.ms with
+# taql, then make reference MSs for each triangle.
+
+def closure_taql(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
+                 scratch='.'):
+    cltxt,clwhich = [os.path.join(scratch,f) for f in ('closure_txt','closure_which')]
+    cltemp = os.path.join(scratch,'cl_temp.ms')
+    cltemps = [os.path.join(scratch,'closure_temp%d.ms'%i) for i in (1,2,3)]
+
+    # Find array of requested telescopes and list of telescopes in data
+    command = 'taql \'select NAME from %s/ANTENNA\' >%s'%(vis,cltxt)
     os.system(command)
-    os.system('grep -v select closure_txt >closure_which')
-    idxtel = np.loadtxt('closure_which',dtype='S')
+    os.system('grep -v select %s >%s'%(cltxt,clwhich))
+    idxtel = np.loadtxt(clwhich,dtype='S')
     atel = np.unique(np.ravel(tel))
 
     # For each requested telescope, determine its position in the list
@@ -90,19 +286,19 @@ def closure(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
     # Make a smaller MS 'as plain' with the required baseline. This is slow
     # but only needs doing once for an arbitrary number of baselines.
 
-    if os.path.exists ('cl_temp.ms'):
-        os.system('rm -fr cl_temp.ms')
+    if os.path.exists (cltemp):
+        os.system('rm -fr %s'%cltemp)
     command = 'taql \'select from %s where ' % vis
     for i in range (len(aidx_s)):
         for j in range (i+1, len(aidx_s)):
             command += ('ANTENNA1==%d and ANTENNA2==%d' % \
                             (aidx_s[i],aidx_s[j]))
             if i==len(aidx_s)-2 and j==len(aidx_s)-1:
-                command += (' giving cl_temp.ms as plain\'')
+                command += (' giving %s as plain\'' % cltemp)
             else:
                 command += (' or ')
 
-    print 'Selecting smaller MS cl_temp.ms, this will take about 4s/Gb:'
+    print 'Selecting smaller MS %s, this will take about 4s/Gb:'%cltemp
     os.system (command)
 
     # Loop around the requested closure triangles
@@ -114,21 +310,18 @@ def closure(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
             tri = np.append (tri, aidx[np.argwhere(atel==tr[i])[0][0]])
         tri = np.sort(tri)
         # Make three reference MSs with pointers into the small MS
-        command = 'taql \'select from cl_temp.ms where ANTENNA1==%d and ANTENNA2==%d giving closure_temp1.ms\'' %(tri[0],tri[1])
+        command = 'taql \'select from %s where ANTENNA1==%d and ANTENNA2==%d giving %s\'' %(cltemp,tri[0],tri[1],cltemps[0])
         os.system(command)
-        command = 'taql \'select from cl_temp.ms where ANTENNA1==%d and ANTENNA2==%d giving closure_temp2.ms\'' %(tri[1],tri[2])
+        command = 'taql \'select from %s where ANTENNA1==%d and ANTENNA2==%d giving %s\'' %(cltemp,tri[1],tri[2],cltemps[1])
         os.system(command)
-        command = 'taql \'select from cl_temp.ms where ANTENNA1==%d and ANTENNA2==%d giving closure_temp3.ms\'' %(tri[0],tri[2])
+        command = 'taql \'select from %s where ANTENNA1==%d and ANTENNA2==%d giving %s\'' %(cltemp,tri[0],tri[2],cltemps[2])
         os.system(command)
 
         # Load data arrays and get amp, closure phase
 
-        t1 = pt.table('closure_temp1.ms')
-        t2 = pt.table('closure_temp2.ms')
-        t3 = pt.table('closure_temp3.ms')
-        ut = t1.select('TIME')
-        spw = t1.select('DATA_DESC_ID')
-        d1,d2,d3 = t1.select('DATA'), t2.select('DATA'), t3.select('DATA')
+        t1,t2,t3 = [pt.table(f) for f in cltemps]
+        spw = t1.getcol('DATA_DESC_ID')
+        d1,d2,d3 = t1.getcol('DATA'), t2.getcol('DATA'), t3.getcol('DATA')
         clthis, cp = get_amp_clph(d1[:lastv],d2[:lastv],d3[:lastv],spw[:lastv],
              pol=0, use_spw=use_spw, bchan=bchan, echan=echan)
         try:
@@ -136,17 +329,11 @@ def closure(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
         except:
             allcp = [cp]
 
-        os.system('rm -fr closure_temp*ms')
-        if os.path.exists ('closure_which'):
-            os.system('rm closure_which')
+        os.system('rm -fr %s'%' '.join(cltemps))
+        if os.path.exists (clwhich):
+            os.system('rm %s'%clwhich)
         clstats = np.append (clstats, clthis)
-    if doplot:
-        cl_mkplot (allcp,tel,target_id)
-    clstats = clstats[0] if len(clstats)==1 else clstats
-    if doret:
-        return clstats,allcp
-    else:
-        return clstats
+    return clstats,allcp
 
 def cl_mkplot(allcp,tel,target_id):
     ny = int(np.floor(np.sqrt(np.float(len(allcp)))))
@@ -161,48 +348,118 @@ def cl_mkplot(allcp,tel,target_id):
                  transform=ax.transAxes)
     plt.savefig('%s_closure.png'%target_id,bbox_inches='tight')
 
+# Closure phase and best averaged statistic for three baselines given as
+# (time, chan, pol) arrays, e.g. from getcol('DATA')
+
 def get_amp_clph(d1,d2,d3,spw,pol=0,use_spw=0,bchan=0,echan=-1):
-    a1,a2,a3,cp = np.array([]),np.array([]),np.array([]),np.array([])
-    p1,p2,p3 = np.array([]),np.array([]),np.array([])
-    nchan = np.int(len(d1[0]['DATA']))
+    clph = closure_kernel(d1,d2,d3,spw,pol=pol,use_spw=use_spw,\
+                          bchan=bchan,echan=echan)
+    return clph_stat(clph),clph
+
+# Batched closure-phase kernel, shared by all closure callers. d1,d2,d3 are
+# the complex (time, chan, pol) arrays of baselines 0-1, 1-2 and 0-2, spw
+# the DATA_DESC_ID of each time. The SPW mask and channel window are applied
+# in one step, the channels summed and the closure phase formed from the
+# triple product, so it is already wrapped into -pi..pi.
+
+def closure_kernel(d1,d2,d3,spw,pol=0,use_spw=0,bchan=0,echan=-1):
+    sel = np.asarray(spw)==use_spw
+    s1,s2,s3 = [chan_sum(d[sel],pol=pol,bchan=bchan,echan=echan) \
+                for d in (d1,d2,d3)]
+    clph = closure_phasors(s1,s2,s3)
+    return clph[~np.isnan(clph)]
+
+# Closure phase from the complex (e.g. channel-summed) visibilities of
+# baselines 0-1, 1-2 and 0-2, via the triple product
+
+def closure_phasors(s1,s2,s3):
+    trip = s1*s2*np.conj(s3)
+    return np.arctan2(trip.imag,trip.real)
+
+# Generator reading a table (e.g. one baseline selected with selectrows or
+# query, which only holds row numbers) in blocks of nrow rows with
+# getcol(startrow,nrow), so that only one block of DATA is in memory
+
+def baseline_blocks(tb,columns,nrow=BLOCKROWS):
+    for start in range(0,tb.nrows(),nrow):
+        yield dict([(c,tb.getcol(c,startrow=start,nrow=nrow)) for c in columns])
+
+# Streaming reduction of a baseline to one value per timestamp: the
+# channel sum of pol (all spectral windows at a time are added together),
+# the summed amplitude, the number of channels summed and the UVW. Each
+# block is reduced as it is read, so peak memory does not depend on the
+# length of the observation.
+
+def baseline_reduce(tb,pol=0,bchan=0,echan=-1,nrow=BLOCKROWS):
+    ut,vsum,asum,nsum,uvw = [],[],[],[],[]
+    for blk in baseline_blocks(tb,['TIME','UVW','DATA'],nrow=nrow):
+        d = blk['DATA']
+        ut.append(blk['TIME'])
+        uvw.append(blk['UVW'])
+        vsum.append(chan_sum(d,pol=pol,bchan=bchan,echan=echan))
+        asum.append(chan_sum(abs(d),pol=pol,bchan=bchan,echan=echan))
+        nsum.append(chan_sum(np.isfinite(d)*1.0,pol=pol,bchan=bchan,echan=echan))
+    ut,uvw = np.concatenate(ut+[[]]),np.concatenate(uvw+[np.zeros((0,3))])
+    vsum = np.concatenate(vsum+[np.zeros(0,dtype='complex')])
+    asum,nsum = np.concatenate(asum+[[]]),np.concatenate(nsum+[[]])
+    utime,first,inv = np.unique(ut,return_index=True,return_inverse=True)
+    vsum = np.bincount(inv,vsum.real)+1j*np.bincount(inv,vsum.imag)
+    return utime,vsum,np.bincount(inv,asum),np.bincount(inv,nsum),uvw[first]
+
+# Sum over the channel window bchan:echan of one polarization of a
+# (time, chan, pol) array
+
+def chan_sum(d,pol=0,bchan=0,echan=-1):
+    nchan = d.shape[1]
     bchan = max(bchan,0)
-    if echan==-1 or echan>nchan:  # bugfix
+    if echan==-1 or echan>nchan:
         echan=nchan
-    for i in range(len(d1)):
-        if spw[i].values()[0] != use_spw:
-            continue
-        vis1,vis2,vis3 = d1[i]['DATA'][bchan:echan,pol],\
-                         d2[i]['DATA'][bchan:echan,pol],\
-                         d3[i]['DATA'][bchan:echan,pol]
-        pd1,pd2,pd3 = np.nansum(vis1),np.nansum(vis2),np.nansum(vis3)
-        p1 = np.append(p1, np.arctan2 (pd1.imag,pd1.real))
-        p2 = np.append(p2, np.arctan2 (pd2.imag,pd2.real))
-        p3 = np.append(p3, np.arctan2 (pd3.imag,pd3.real))
-    clph = p1+p2-p3
-    clph = clph[~np.isnan(clph)]
-    np.putmask (clph,clph<-np.pi,clph+2*np.pi)
-    np.putmask (clph,clph>np.pi,clph-2*np.pi)
-    x,y,z = np.arange(1,30),np.array([]),np.array([])
-    for i in x:
-        y = np.append(y,np.mean(np.gradient(np.unwrap(phavg(clph,i)))**2))
+    return np.nansum(d[:,bchan:echan,pol],axis=1)
+
+# Best statistic obtained by averaging the closure phases by factors of
+# 1 to nmax (default 29). The averages for every factor come from one set
+# of prefix sums of the unit phasors, whose differences give the phase
+# of the mean phasor of each chunk of n.
+# The statistic for each factor is the mean square of the gradient of the
+# unwrapped averaged phase, formed directly from the wrapped phase
+# differences of consecutive averages, and the cubic is fitted and
+# evaluated in one call.
+
+def clph_stat(clph,nmax=29):
+    csum = np.zeros(len(clph)+1,dtype='complex')
+    np.cos(clph,out=csum.real[1:])      # cheaper than np.exp(1j*clph)
+    np.sin(clph,out=csum.imag[1:])
+    csum = np.cumsum(csum)
+    x,y = np.arange(1,nmax+1),np.zeros(nmax)
+    for i in range(nmax):
+        n = x[i]
+        m = n*(len(clph)//n)
+        avg = csum[n:m+1:n]-csum[0:m-n+1:n]
+        dph = np.angle(avg[1:]*np.conj(avg[:-1]))
+        mid = dph[1:]+dph[:-1]   # np.gradient is dph at the ends
+        y[i] = (dph[0]**2+dph[-1]**2+0.25*np.dot(mid,mid))/len(avg)
     pfit = np.polyfit (x,y,3)
-    for i in x:
-        z = np.append(z,np.poly1d(pfit)(i))
-    return z.min(),clph
+    return np.polyval(pfit,x).min()
 
-def phavg (phase, n):
-    phase = phase[0:n*(len(phase)//n)]
-    rreal,rimag = np.cos(phase), np.sin(phase)
-    arreal = np.average (np.reshape(rreal,(-1,n)),axis=1)
-    arimag = np.average (np.reshape(rimag,(-1,n)),axis=1)
-    return np.arctan2 (arimag, arreal)
+# Pool worker for main: run closure on one MS with its own scratch
+# directory, so that parallel taql selections do not overwrite each other
+
+def closure_thread(args):
+    ms,tel,kwargs = args
+    print 'Now operating on', ms
+    scratch = tempfile.mkdtemp(prefix='closure_scratch_',dir='.')
+    try:
+        return closure(ms,tel,scratch=scratch,**kwargs)
+    finally:
+        os.system('rm -fr %s'%scratch)
 
 #ctel = 'ST001;DE601;DE603;ST001;FR606;DE609'
 #closure ('L328370.ms',ctel,doplot=True)
 
 
 def main(ms_input,station_input,lastv=-1,pol=0,use_spw=0,bchan=0,\
-             echan=-1,doplot=False,doret=False,dopipe=True):
+             echan=-1,doplot=False,doret=False,dopipe=True,inprocess=False,\
+             usecache=True,ncpu=1,ioslots=None):
     """
     Deriving closure phases of all directions
    
@@ -223,6 +480,15 @@ def main(ms_input,station_input,lastv=-1,pol=0,use_spw=0,bchan=0,\
     dopipe  (bool, default True): For backwards compatibility. If dopipe
             is True, will write text in the closure_phase file as before.
             If True, station_input will be truncated to 3 stations.
+    inprocess (bool, default False): If True, read the triangle baselines
+            directly with casacore instead of writing temporary MSs with taql
+    usecache (bool, default True): With inprocess, reuse closure results
+            cached for an unchanged MS and store new ones
+    ncpu    (int, default 1): Number of MSs processed in parallel. Each
+            worker uses its own scratch directory; results are returned
+            (and written) in the order of ms_input
+    ioslots (int, default ncpu): Number of those workers allowed to read
+            or write their MS at the same time
         
     Returns
     -------
@@ -240,14 +506,28 @@ def main(ms_input,station_input,lastv=-1,pol=0,use_spw=0,bchan=0,\
         print 'dopipe True, truncating to 3 telescopes'
         tel = tel[:3]
     tel = tel.reshape(len(tel)/3,3)
-    for ms in mslist:
-        print 'Now operating on', ms
-        scatter_cp = closure(ms,tel,lastv=lastv,pol=pol,\
-                             use_spw=use_spw,bchan=bchan,echan=echan,\
-                             doplot=doplot,doret=doret)
+    kwargs = {'lastv':lastv,'pol':pol,'use_spw':use_spw,'bchan':bchan,\
+              'echan':echan,'doplot':doplot,'doret':doret,\
+              'inprocess':inprocess,'usecache':usecache}
+    ncpu = int(ncpu)
+    ioslots = int(ioslots) if ioslots else ncpu
+    if ncpu > 1:
+        print 'Operating on',len(mslist),'MSs using',ncpu,'cores'
+        results = [None]*len(mslist)
+        for i,r in schedule(closure_thread,[(ms,tel,kwargs) for ms in mslist],\
+                            cores=ncpu,io=ioslots,need=(1,0,1)):
+            results[i] = r
+    else:
+        results = []
+        for ms in mslist:
+            print 'Now operating on', ms
+            results.append(closure(ms,tel,**kwargs))
+    for ms,scatter_cp in zip(mslist,results):
         if dopipe:
             print '\n Scatter for the direction ' + ms.split('/')[-1].split('_')[0] + ' is %s \n' % scatter_cp
             os.system('echo Scatter for the direction ' + ms.split('/')[-1].split('_')[0] + ' is ' + str(scatter_cp) + ' >> closure_phases.txt')
+            put_result(ms.split('/')[-1].split('_')[0],scatter_cp,\
+                       triangle=';'.join(tel[0]),nsubbands=1,mode='closure_v4')
         else:
             try:
                 allret.append(scatter_cp)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+import sys,numpy as np
+
+# Catalogue cross-matching, shared by skynet_master, first_index and the
+# correlate plugins. array2 is cut into declination zones of height dist and
+# sorted by (zone, ra); each row of array1 then looks only at the ra window
+# of width +-dist/cos(dec) in its own zone and the two neighbouring ones,
+# and the candidate pairs of a block of array1 rows have their separations
+# computed together. No ordering of the inputs is assumed.
+
+BLOCK = 4000000      # candidate pairs evaluated at a time
+
+# Great-circle separation in degrees (haversine, good at small angles)
+
+def sepn_deg(ra1,dec1,ra2,dec2):
+    ra1,dec1,ra2,dec2 = [np.deg2rad(x) for x in (ra1,dec1,ra2,dec2)]
+    h = np.sin(0.5*(dec2-dec1))**2+np.cos(dec1)*np.cos(dec2)*np.sin(0.5*(ra2-ra1))**2
+    return np.rad2deg(2.0*np.arcsin(np.sqrt(np.clip(h,0.0,1.0))))
+
+# Pairs of rows of array1 and array2 closer than dist (degrees, or the
+# units of the columns if isabs, where the distance is planar) and at least
+# mindist apart. Returns an array of (i, j, distance) rows ordered by i then
+# j, or an empty array if there are none.
+
+def correlate (array1, ra1, dec1, array2, ra2, dec2, dist, \
+               mindist=0.0, isabs=False, noisy=True):
+    r1,d1 = np.asarray(array1[:,ra1],dtype='float'),np.asarray(array1[:,dec1],dtype='float')
+    r2,d2 = np.asarray(array2[:,ra2],dtype='float'),np.asarray(array2[:,dec2],dtype='float')
+    if not len(r1) or not len(r2):
+        return np.array([])
+    if isabs:
+        base = min(r1.min(),r2.min())
+        r1,r2 = r1-base,r2-base
+        span = max(r1.max(),r2.max())
+        w = np.ones(len(r1))*dist
+    else:
+        r1,r2 = r1%360.0,r2%360.0
+        span = 360.0
+        w = dist/np.cos(np.deg2rad(np.minimum(abs(d1)+dist,90.0))).clip(1.e-9)
+        w = np.where(w<90.0,1.0001*w,360.0)     # pad for rounding; whole zone near poles
+    zsize = dist if dist>0 else 1.0
+    zmul = 2.0*span+1.0                         # key = zone*zmul + ra
+    dbase = min(d1.min(),d2.min())
+    key = np.floor((d2-dbase)/zsize)*zmul+r2
+    order = np.argsort(key,kind='mergesort')
+    key,r2,d2 = key[order],r2[order],d2[order]
+    # ra windows to search for each row of array1, split where they wrap
+    z1 = np.floor((d1-dbase)/zsize)*zmul
+    lo,hi = r1-w,r1+w
+    full = w>=180.0
+    qi,qlo,qhi = [],[],[]
+    for dz in (-zmul,0.0,zmul):
+        qi.append(np.arange(len(r1)))
+        qlo.append(z1+dz+lo.clip(0.0,span))
+        qhi.append(z1+dz+hi.clip(0.0,span))
+        if not isabs:
+            for m,l,h in (((lo<0.0)&~full,lo+360.0,0.0*lo+360.0),\
+                          ((hi>=360.0)&~full,0.0*hi,hi-360.0)):
+                qi.append(np.arange(len(r1))[m])
+                qlo.append(z1[m]+dz+l[m])
+                qhi.append(z1[m]+dz+h[m])
+    qi = np.concatenate(qi)
+    # the bounds are summed differently from key, so widen them by a few
+    # rounding errors of the largest key (far less than the zone gap)
+    eps = 1.e-12*(abs(key).max()+abs(z1).max()+2.0*zmul)
+    first = np.searchsorted(key,np.concatenate(qlo)-eps,side='left')
+    ncand = np.searchsorted(key,np.concatenate(qhi)+eps,side='right')-first
+    ends = np.cumsum(ncand)
+    correl = []
+    qstart = 0
+    while qstart < len(qi):
+        qend = max(qstart+1,np.searchsorted(ends,ends[qstart]-ncand[qstart]+BLOCK,\
+                                            side='right'))
+        n = ncand[qstart:qend]
+        ii = np.repeat(qi[qstart:qend],n)
+        jj = np.repeat(first[qstart:qend]-np.cumsum(n)+n,n)+np.arange(n.sum())
+        if isabs:
+            adist = np.hypot(r1[ii]-r2[jj],d1[ii]-d2[jj])
+        else:
+            adist = sepn_deg(r1[ii],d1[ii],r2[jj],d2[jj])
+        keep = (adist<dist)&(adist>=mindist)
+        correl.append(np.column_stack((ii[keep],order[jj[keep]],adist[keep])))
+        if noisy:
+            sys.stdout.write('*')
+            sys.stdout.flush()
+        qstart = qend
+    correl = np.vstack(correl)
+    if not len(correl):
+        return np.array([])
+    return correl[np.lexsort((correl[:,1],correl[:,0]))]
@@ -12,6 +12,32 @@ from matplotlib import pyplot as plt
 import argparse
 from astropy.io import ascii
 import re
+import fnmatch
+import time
+import hashlib
+import json
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from closure_v4 import closure_kernel, closure_phasors, baseline_blocks, \
+     match_tels, get_antenna_names, ms_stamp
+from task_scheduler import parallel_function, schedule
+from results_store import put_result, mark_done, get_done
+
+C_LIGHT = 299792458.0
+MYTELS = ['DE601','DE605','ST001']      # closure triangle for screening
+SUPERSTATIONS = {'ST001':'CS*'}         # as made by the NDPPP stationadder
+SCREENPHASORS = 4000000  # max rows x directions x channels in one block
+PRESCREEN = None         # closure scatter above which no shifted MS is made
+                         # (random phases give ~1.64); None = no pre-screen
+PROGRESSIVE_START = 4    # subbands in the first progressive screening step
+PROGRESSIVE_REJECT = 1.55 # least scatter at which a direction is dropped as
+PROGRESSIVE_NSIGMA = 3.0 # random, and only within this many sd of random
+PROGRESSIVE_ACCEPT = 0.2 # scatter below which a direction needs no more data
+RANDOM_SCATTER = np.pi**2/6   # mean scatter of random closure phases, and its
+RANDOM_SCATTER_SD = 2.2       # sd times sqrt(number of closure samples)
+NDPPP_NEED = (1,2*1024**3,1)  # cores, memory, I/O slots of one NDPPP shift
+FSTEP,TSTEP = 8,8        # channels, integrations averaged in the NDPPP shifts
+RUNSTAMP = ''            # fingerprint of the subbands and settings of a run
+SBINDEX = 'subband_index'     # prefix of the saved subband metadata index
 
 def natural_sort(l):
     convert = lambda text: int(text) if text.isdigit() else text.lower()
@@ -98,10 +124,9 @@ def closure(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
         t1 = pt.table(outfile.replace('tmp','tmp_1'))
         t2 = pt.table(outfile.replace('tmp','tmp_2'))
         t3 = pt.table(outfile.replace('tmp','tmp_3'))
-        ut = t1.select('TIME')
-        spw = t1.select('DATA_DESC_ID')
-        d1,d2,d3 = t1.select('DATA'), t2.select('DATA'), t3.select('DATA')
-        cp = get_amp_clph(d1[:lastv],d2[:lastv],d3[:lastv],spw[:lastv],
+        spw = t1.getcol('DATA_DESC_ID')
+        d1,d2,d3 = t1.getcol('DATA'), t2.getcol('DATA'), t3.getcol('DATA')
+        cp = closure_kernel(d1[:lastv],d2[:lastv],d3[:lastv],spw[:lastv],
              pol=0, use_spw=use_spw, bchan=bchan, echan=echan)
         try:
             allcp.append(cp)
@@ -111,7 +136,7 @@ def closure(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
         os.system('rm -fr tmp_*%s'%vis)
 	os.system('rm -fr '+closure_txt_file)
 	os.system('rm -fr '+closure_which_file)
-        clstats = np.append (clstats, np.nanmean(np.gradient(np.unwrap(cp))**2))
+        clstats = np.append (clstats, clph_scatter(cp))
     if doplot:
         cl_mkplot (allcp,tel,target_id)
     clstats = clstats[0] if len(clstats)==1 else clstats
@@ -120,6 +145,13 @@ def closure(vis,tel,lastv=-1,pol=0,use_spw=0,bchan=0,echan=-1,\
     else:
         return clstats
 
+# Scatter of a closure phase series: mean square of its derivative
+
+def clph_scatter(cp):
+    if len(cp) < 2:
+        return np.nan
+    return np.nanmean(np.gradient(np.unwrap(cp))**2)
+
 def cl_mkplot(allcp,tel,target_id):
     ny = int(np.floor(np.sqrt(np.float(len(allcp)))))
     nx = 1+len(allcp)/ny if len(allcp)%ny else len(allcp)/ny
@@ -133,62 +165,276 @@ def cl_mkplot(allcp,tel,target_id):
                  transform=ax.transAxes)
     plt.savefig('%s_closure.png'%target_id,bbox_inches='tight')
 
-def get_amp_clph(d1,d2,d3,spw,pol=0,use_spw=0,bchan=0,echan=-1):
-    a1,a2,a3,cp = np.array([]),np.array([]),np.array([]),np.array([])
-    p1,p2,p3 = np.array([]),np.array([]),np.array([])
-    nchan = np.int(len(d1[0]['DATA']))
-    bchan = max(bchan,0)
-    if echan==-1 or echan<nchan:
-        echan=nchan
-    for i in range(len(d1)):
-        if spw[i].values()[0] != use_spw:
-            continue
-        vis1,vis2,vis3 = d1[i]['DATA'][bchan:echan,pol],\
-                         d2[i]['DATA'][bchan:echan,pol],\
-                         d3[i]['DATA'][bchan:echan,pol]
-        pd1,pd2,pd3 = np.nansum(vis1),np.nansum(vis2),np.nansum(vis3)
-        p1 = np.append(p1, np.arctan2 (pd1.imag,pd1.real))
-        p2 = np.append(p2, np.arctan2 (pd2.imag,pd2.real))
-        p3 = np.append(p3, np.arctan2 (pd3.imag,pd3.real))
-    return p1+p2-p3
-
-def addghost (inarray):        # deal with missing frequencies between subbands
-    n = len(inarray)
-    fdel = []
-    for i in range(n):         # first delete if things do not exist
-        if not os.path.isdir(inarray[i]):
-            print '----->> %s does not exist as an MS'%inarray[i]
-            fdel.append(i)
-    inarray = np.delete(inarray,fdel)
-    for i in range(n):         # make 2-d array of frequencies from chan x files
-	spw_table = os.path.join( inarray[i], 'SPECTRAL_WINDOW' )
-        newfreq = pt.table(spw_table).getcol('CHAN_FREQ')
+# Subband metadata index, built once per run: the frequencies of all
+# subbands that exist (one (nsb,nchan) array, saved as .npy so workers can
+# memory-map it), the reference frequency and channel width, the layout of
+# existing subbands and 'ghost' entries for missing ones between them, and
+# the difmap select string. Saved under prefix (.json and _freq.npy) unless
+# prefix is None.
+
+def build_subband_index (inarray, prefix=SBINDEX):
+    exist = []
+    for ms in inarray:         # first delete if things do not exist
+        if os.path.isdir(ms):
+            exist.append(ms)
+        else:
+            print '----->> %s does not exist as an MS'%ms
+    freq = None
+    for i in range(len(exist)):   # 2-d array of frequencies, files x chan
+        spw_table = pt.table(os.path.join(exist[i],'SPECTRAL_WINDOW'),ack=False)
+        newfreq = spw_table.getcol('CHAN_FREQ')
+        spw_table.close()
         if newfreq.ndim == 2:
             newfreq = newfreq[0]
-        try:
-            freq = np.vstack((freq,newfreq))
-        except:
-            freq = np.copy(newfreq)
-            fref,chwid = freq[0],freq[1]-freq[0]
-            ch_sub = len(freq)
-
-    rfreq=np.rint((freq-fref)/chwid)
-    if rfreq.ndim == 1:
-        rfreq = np.array([rfreq])    # only one SB, ensure a 2D array
-    fo = open('difmap_select','w')   # write select for difmap to exclude flagged if you
-    fo.write('select I,')            # run difmap later: difmap crashes on missing chans
-    for i in range(len(rfreq)):
-        fo.write('%d,%d' % (1+int(rfreq[i,0]),1+int(rfreq[i,-1])))
-        fo.write('\n' if i==len(rfreq)-1 else ',')
-    fo.close()
-    outarray = np.array([inarray[0]])
-    for i in range(1,n):        # for each file, see how many ghosts go between
+        if freq is None:
+            freq = np.zeros((len(exist),len(newfreq)))
+        freq[i] = newfreq
+    fref,chwid = freq[0,0],freq[0,1]-freq[0,0]
+    ch_sub = freq.shape[1]
+    rfreq = np.rint((freq-fref)/chwid)
+    # select for difmap to exclude flagged if you run difmap later:
+    # difmap crashes on missing chans
+    select = 'select I,' + ','.join(['%d,%d'%(1+int(r[0]),1+int(r[-1])) \
+                                     for r in rfreq]) + '\n'
+    layout = [exist[0]]        # for each file, see how many ghosts go between
+    for i in range(1,len(exist)):
         nghost = int(np.rint((rfreq[i,0]-rfreq[i-1,-1]-1.)/ch_sub))
-        for j in range(nghost):
-            outarray=np.append(outarray, 'ghost')
-        outarray=np.append(outarray,inarray[i])
-    return outarray   
+        layout += ['ghost']*nghost + [exist[i]]
+    index = {'inarray':list(inarray),'msin':exist,'fref':fref,'chwid':chwid,\
+             'nchan':ch_sub,'layout':layout,'difmap_select':select}
+    if prefix is not None:
+        np.save(prefix+'_freq.npy',freq)
+        fo = open(prefix+'.json','w')
+        json.dump(index,fo)
+        fo.close()
+    index['freq'] = freq
+    return index
+
+def load_subband_index (prefix=SBINDEX):
+    fo = open(prefix+'.json')
+    index = json.load(fo)
+    fo.close()
+    index['freq'] = np.load(prefix+'_freq.npy',mmap_mode='r')
+    return index
 
+def addghost (inarray):        # deal with missing frequencies between subbands
+    index = build_subband_index(inarray,prefix=None)
+    fo = open('difmap_select','w')
+    fo.write(index['difmap_select'])
+    fo.close()
+    return np.array(index['layout'])
+
+# Ghost layout of inarray from the run's saved index if it was built for
+# the same subbands, otherwise from the subbands themselves
+
+def subband_layout (inarray, prefix=SBINDEX):
+    if os.path.exists(prefix+'.json'):
+        index = load_subband_index(prefix)
+        if index['inarray'] == list(inarray):
+            return np.array(index['layout'])
+    return addghost(inarray)
+
+
+# Direction cosines of (ra,dec) relative to the phase centre (ra0,dec0),
+# all in radians; ra and dec may be arrays of directions
+
+def radec2lmn(ra,dec,ra0,dec0):
+    dra = ra-ra0
+    l = np.cos(dec)*np.sin(dra)
+    m = np.sin(dec)*np.cos(dec0)-np.cos(dec)*np.sin(dec0)*np.cos(dra)
+    n = np.sin(dec)*np.sin(dec0)+np.cos(dec)*np.cos(dec0)*np.cos(dra)
+    return np.array([l,m,n])
+
+# Map the baselines of a MS onto the three baselines of a closure triangle.
+# A telescope of tel which is not in the MS but is in groups is a station
+# group (ST001 = all CS stations), which counts as the last antenna, as it
+# would be after the NDPPP stationadder. Returns blmap[a1,a2] = 0,1,2 for
+# the triangle baselines 0-1, 1-2, 0-2 in sorted order as in closure_v4
+# (-1 otherwise), blconj[a1,a2] True where a row must be conjugated to
+# get that orientation, and the list of antennas making each telescope.
+
+def triangle_map(names,tel,groups=SUPERSTATIONS):
+    nant = len(names)
+    members,order = [],[]
+    for t in tel:
+        idx = match_tels([t],names)[0]
+        if idx < 0 and t in groups:
+            members.append([i for i in range(nant) if fnmatch.fnmatch(names[i],groups[t])])
+            order.append(nant)
+        else:
+            members.append([idx] if idx >= 0 else [])
+            order.append(idx)
+    members = [members[i] for i in np.argsort(order,kind='mergesort')]
+    blmap = -np.ones((nant,nant),dtype='int')
+    blconj = np.zeros((nant,nant),dtype='bool')
+    for k,(i,j) in enumerate([(0,1),(1,2),(0,2)]):
+        for a in members[i]:
+            for b in members[j]:
+                blmap[a,b] = blmap[b,a] = k
+                blconj[b,a] = True
+    return blmap,blconj,members
+
+# Single-read screening engine. One subband is read once, in blocks, and
+# only for the rows of the closure triangle baselines (including every
+# baseline to a member of ST001). For all candidate directions at once the
+# data are rotated to the new phase centre by
+#    exp(2 pi i nu/c (u l + v m + w (n-1)))
+# with (l,m,n) of the candidate relative to the FIELD phase centre; flagged
+# data are zeroed, and the rotated data summed over channels, over the
+# members of ST001 and over time bins of tstep integrations. These are the
+# linear parts of the shift/avg/sadder steps of combine_subbands, so the
+# closure phases come straight from the sums. radec is (ndir,2) in degrees.
+# The sums are added into acc (ndir x 3 baselines x time bin, with the
+# time grid) which is returned, so that further subbands can be added.
+
+def shift_accumulate(vis,radec,tel=MYTELS,datacol='DATA',tstep=TSTEP,pol=0,\
+                     acc=None):
+    radec = np.radians(np.atleast_2d(radec))
+    names = get_antenna_names(vis)
+    blmap,blconj,members = triangle_map(names,tel)
+    if not all([len(m) for m in members]):
+        print 'Not all of',tel,'found in',vis,'- skipping it'
+        return acc
+    tf = pt.table(vis+'/FIELD',ack=False)
+    ra0,dec0 = tf.getcol('PHASE_DIR')[0,0]
+    tf.close()
+    ts = pt.table(vis+'/SPECTRAL_WINDOW',ack=False)
+    freq = ts.getcol('CHAN_FREQ')
+    ts.close()
+    lmn = radec2lmn(radec[:,0],radec[:,1],ra0,dec0)
+    lmn[2] -= 1.0
+    ndir,nchan = len(radec),freq.shape[1]
+
+    t = pt.table(vis,ack=False)
+    rows = np.where(blmap[t.getcol('ANTENNA1'),t.getcol('ANTENNA2')]>=0)[0]
+    if not len(rows):
+        print 'No data on the baselines of',tel,'in',vis,'- skipping it'
+        t.close()
+        return acc
+    if acc is None:
+        acc = {'t0':t.getcol('TIME',startrow=rows[0],nrow=1)[0],\
+               'dt':tstep*t.getcol('INTERVAL',startrow=rows[0],nrow=1)[0],\
+               'vsum':np.zeros((ndir,3,0),dtype='complex')}
+    columns = ['ANTENNA1','ANTENNA2','TIME','UVW','DATA_DESC_ID','FLAG',datacol]
+    nrow = max(1,SCREENPHASORS//(ndir*nchan))
+    for blk in baseline_blocks(t.selectrows(rows),columns,nrow=nrow):
+        a1,a2 = blk['ANTENNA1'],blk['ANTENNA2']
+        d = np.where(blk['FLAG'][:,:,pol],0.0,blk[datacol][:,:,pol])
+        d[~np.isfinite(d)] = 0.0
+        ph = np.dot(blk['UVW'],lmn)*(2.0*np.pi/C_LIGHT)
+        nu = freq[blk['DATA_DESC_ID']]
+        vs = np.einsum('rdc,rc->dr',np.exp(1j*ph[:,:,None]*nu[:,None,:]),d)
+        vs = np.where(blconj[a1,a2],np.conj(vs),vs)
+        tbin = np.floor((blk['TIME']-acc['t0'])/acc['dt']+1.e-6).astype('int')
+        keep = tbin >= 0
+        if tbin.max()+1 > acc['vsum'].shape[2]:
+            grow = tbin.max()+1-acc['vsum'].shape[2]
+            acc['vsum'] = np.concatenate((acc['vsum'],\
+                          np.zeros((ndir,3,grow),dtype='complex')),axis=2)
+        np.add.at(acc['vsum'],(slice(None),blmap[a1,a2][keep],tbin[keep]),vs[:,keep])
+    t.close()
+    return acc
+
+# Closure scatter of every direction from the sums of shift_accumulate.
+# Time bins where any of the three baselines has no data are dropped.
+
+def shift_scatter(acc):
+    v = acc['vsum']
+    cp = closure_phasors(v[:,0],v[:,1],v[:,2])
+    good = np.all(v!=0.0,axis=1)
+    return np.array([clph_scatter(cp[i][good[i]]) for i in range(len(v))])
+
+# Screen all candidate directions with one read of each subband. coords
+# are 'ra,dec,source' strings (degrees) as from lotss2coords; returns the
+# closure scatter of each, in the order of coords.
+
+def screen_sources(mslist,coords,datacol='DATA',tstep=TSTEP,tel=MYTELS):
+    radec = np.array([c.split(',')[:2] for c in coords],dtype='float')
+    acc = None
+    for ms in mslist:
+        if not os.path.isdir(ms):
+            print '----->> %s does not exist as an MS'%ms
+            continue
+        print 'Screening %d directions in %s'%(len(radec),ms)
+        acc = shift_accumulate(ms,radec,tel=tel,datacol=datacol,\
+                               tstep=tstep,acc=acc)
+    if acc is None:
+        return np.nan*np.ones(len(radec))
+    return shift_scatter(acc)
+# Order in which to add subbands so that every leading part of the list
+# is spread over the whole band (bit-reversed index order)
+
+def spread_order(n):
+    nbit = max(1,int(np.ceil(np.log2(max(n,1)))))
+    rev = [int(bin(i)[2:].zfill(nbit)[::-1],2) for i in range(n)]
+    return list(np.argsort(rev,kind='mergesort'))
+
+# Progressive-bandwidth screening. All directions start on nstart subbands
+# spread over the band; directions that are already clearly coherent (below
+# accept) or still indistinguishable from random are finished, and the
+# number of subbands is doubled for the rest, adding only the new subbands
+# to their accumulated sums. The scatter saturates near random at low S/N,
+# so a direction only counts as random if its scatter is at least reject
+# and within nsigma standard deviations of that of random phases over the
+# same number of closure samples. Directions without a scatter yet (too
+# few time bins) stay in. Returns the scatter of each direction as from
+# the last step it took part in, and the number of subbands that used, in
+# the order of coords.
+
+def progressive_screen(mslist,coords,datacol='DATA',tstep=TSTEP,tel=MYTELS,\
+                       nstart=PROGRESSIVE_START,reject=PROGRESSIVE_REJECT,\
+                       accept=PROGRESSIVE_ACCEPT,nsigma=PROGRESSIVE_NSIGMA):
+    radec = np.array([c.split(',')[:2] for c in coords],dtype='float')
+    for ms in mslist:
+        if not os.path.isdir(ms):
+            print '----->> %s does not exist as an MS'%ms
+    mslist = [ms for ms in mslist if os.path.isdir(ms)]
+    order = [mslist[i] for i in spread_order(len(mslist))]
+    scatter = np.nan*np.ones(len(radec))
+    nsbused = np.zeros(len(radec),dtype='int')
+    active = np.arange(len(radec))
+    acc,nused,nsb = None,0,min(max(1,nstart),len(order))
+    while len(active) and nused < len(order):
+        for ms in order[nused:nsb]:
+            print 'Screening %d directions in %s'%(len(active),ms)
+            sub = None if acc is None else dict(acc,vsum=acc['vsum'][active])
+            sub = shift_accumulate(ms,radec[active],tel=tel,datacol=datacol,\
+                                   tstep=tstep,acc=sub)
+            if sub is None:
+                continue
+            if acc is None:
+                acc = dict(sub,vsum=np.zeros((len(radec),3,0),dtype='complex'))
+            grow = sub['vsum'].shape[2]-acc['vsum'].shape[2]
+            if grow > 0:
+                acc['vsum'] = np.concatenate((acc['vsum'],\
+                              np.zeros((len(radec),3,grow),dtype='complex')),axis=2)
+            acc['vsum'][active] = sub['vsum']
+        nused,nsb = nsb,min(2*nsb,len(order))
+        if acc is None:     # no data yet, try more subbands
+            continue
+        vsum = acc['vsum'][active]
+        scatter[active] = shift_scatter(dict(acc,vsum=vsum))
+        nsbused[active] = nused
+        nbin = np.maximum(np.all(vsum!=0.0,axis=1).sum(axis=1),1)
+        floor = np.maximum(reject,RANDOM_SCATTER-nsigma*RANDOM_SCATTER_SD/np.sqrt(nbin))
+        done = (scatter[active] >= floor) | (scatter[active] < accept)
+        print '%d subbands: %d of %d directions finished'%(nused,done.sum(),len(active))
+        active = active[~done]
+    return scatter,nsbused
+
+# Record the closure scatter of a direction in the results store, and as
+# a line of closure_phases.txt (one write, so lines do not interleave).
+# coord is 'ra,dec,source' as from lotss2coords.
+
+def write_scatter(src,scatter_cp,coord=None,nsubbands=None,mode='ndppp',\
+                  t_start=None):
+    print '\n Scatter for the direction ' + src + ' is %s \n' % scatter_cp
+    fo = open('closure_phases.txt','a')
+    fo.write('Scatter for the direction %s is %s\n'%(src,scatter_cp))
+    fo.close()
+    ra,dec = coord.split(',')[:2] if coord else (None,None)
+    put_result(src,scatter_cp,ra=ra,dec=dec,triangle=';'.join(MYTELS),\
+               nsubbands=nsubbands,mode=mode,t_start=t_start)
 
 
 def combine_subbands (in1array, nameout, phasecenter, fstep, tstep):
@@ -196,7 +442,20 @@ def combine_subbands (in1array, nameout, phasecenter, fstep, tstep):
     tmp = phasecenter.split(';')
     datacol = tmp[0]
     phasecenter = tmp[1]
-    in2array = addghost(inarray)
+    t_start = time.time()
+    nsubbands = len([ms for ms in in1array if os.path.isdir(ms)])
+    if PRESCREEN is not None:
+        # triangle-only pre-screen: rotate and average the triangle
+        # baselines in memory, and only write the shifted MS if it passes
+        scatter_cp = screen_sources(in1array,[phasecenter],datacol=datacol,\
+                                    tstep=tstep)[0]
+        if not scatter_cp <= PRESCREEN:
+            print 'Pre-screen scatter %s above %s, not making %s'%(scatter_cp,PRESCREEN,nameout)
+            write_scatter(nameout.replace('.ms',''),scatter_cp,coord=phasecenter,\
+                          nsubbands=nsubbands,mode='prescreen',t_start=t_start)
+            return scatter_cp
+    os.system('rm -rf %s'%nameout)   # left half-written by a killed run
+    in2array = subband_layout(inarray)
     ismissing = False if np.array_equal(in1array,in2array) else True
     fo=open('NDPPP_%s.parset'%nameout,'w')   # write the parset file
     fo.write('msin = [')
@@ -222,13 +481,18 @@ def combine_subbands (in1array, nameout, phasecenter, fstep, tstep):
     fo.write('filter.baseline = \'!CS*&*\'\n')
     fo.write('filter.remove = True')
     fo.close()
-    os.system('NDPPP NDPPP_%s.parset'%nameout)  # run with NDPPP
-    mytels = [['DE601','DE605','ST001']]
+    if os.system('NDPPP NDPPP_%s.parset'%nameout):  # run with NDPPP
+        print 'NDPPP failed on %s, no scatter for it'%nameout
+        os.system('rm -rf %s'%nameout)
+        os.system('rm NDPPP_%s.parset'%nameout)
+        return None
+    mytels = [MYTELS]
     scatter_cp = closure( nameout, mytels )
-    print '\n Scatter for the direction ' + nameout.replace('.ms','') + ' is %s \n' % scatter_cp
-    os.system( 'echo Scatter for the direction '+nameout.replace('.ms','')+' is '+str(scatter_cp)+' >> closure_phases.txt' )
+    write_scatter(nameout.replace('.ms',''),scatter_cp,coord=phasecenter,\
+                  nsubbands=nsubbands,t_start=t_start)
     os.system( 'rm -rf %s'%nameout )
     os.system('rm NDPPP_%s.parset'%nameout)
+    return scatter_cp
     
 
 def lotss2coords (lotssfile):
@@ -255,36 +519,81 @@ def lotss2coords (lotssfile):
         coords=np.append(coords,tmp_1)
     return coords
 
+# Expected signal of each candidate on the long baselines, in the row order
+# of lotss2coords: LoTSS total flux, times its compactness (peak/total,
+# at most 1) and the fraction of good ('P') LBCS baselines, where the
+# catalogue has these columns
+
+def candidate_priority (lotssfile):
+    a = ascii.read(lotssfile)
+    score = np.array(a['Total_flux'],dtype='float')
+    if 'peak_to_total' in a.colnames:
+        score *= np.clip(np.array(a['peak_to_total'],dtype='float'),0.0,1.0)
+    if 'LBCS_P' in a.colnames:
+        p = np.array(a['LBCS_P'],dtype='float')
+        score *= p/max(p.max(),1.0)
+    return score
+
+
+# Fingerprint of everything a direction's result depends on: the subbands
+# (path, size and modification time), the settings, and the direction
+
+def run_fingerprint (mslist):
+    h = hashlib.sha1()
+    for ms in mslist:
+        stamp = ms_stamp(ms) if os.path.isdir(ms) else 'missing'
+        h.update(('%s %s\n'%(os.path.abspath(ms),stamp)).encode())
+    h.update(('%s %s %d %d'%(';'.join(MYTELS),PRESCREEN,FSTEP,TSTEP)).encode())
+    return h.hexdigest()
+
+def direction_fingerprint (i):
+    return hashlib.sha1((RUNSTAMP+'|'+i).encode()).hexdigest()
 
-def parallel_function(f,ncpu):            # Scott Sievert parallelize function
-    def easy_parallize(f, sequence):
-        from multiprocessing import Pool
-        ncores = int(ncpu)
-        print 'Using',ncores,'cores'
-        pool = Pool(processes=ncores) # depends on available cores
-        result = pool.map(f, sequence) # for i in sequence: result[i] = f(i)
-        cleaned = [x for x in result if not x is None] # getting results
-        cleaned = np.asarray(cleaned)
-        pool.close() # not optimal! but easy
-        pool.join()
-        return cleaned
-    from functools import partial
-    return partial(easy_parallize, f)
 
 def source_thread (i):
     src = i.split(',')[-1]
     print 'PROCESSING SOURCE %s - combining subbands and shifting' % src
-    combine_subbands(inarray,src+'.ms',i,8,8)
+    scatter_cp = combine_subbands(inarray,src+'.ms',i,FSTEP,TSTEP)
+    if scatter_cp is None:      # NDPPP failed, run it again next time
+        print 'PROCESSING SOURCE %s - failed' % src
+        return scatter_cp
+    mark_done(src,direction_fingerprint(i),scatter_cp)
     print 'PROCESSING SOURCE %s - finished' % src
-
-
-def source (coords,ncpu):
-    source_thread.parallel = parallel_function(source_thread,ncpu)
-    parallel_result = source_thread.parallel(coords)
-
-def main( ms_input, lotss_file, ncpu=10, datacol='DATA', nsbs=20 ):
+    return scatter_cp
+
+
+def source (coords,ncpu,stop_scatter=None,ioslots=None):
+    # skip directions finished by an earlier run on the same inputs
+    done = get_done()
+    todo = []
+    for i in coords:
+        src = i.split(',')[-1]
+        if src in done and done[src][0] == direction_fingerprint(i):
+            scatter_cp = done[src][1]
+            print 'SOURCE %s already done, scatter %s' % (src,scatter_cp)
+            if stop_scatter is not None and scatter_cp is not None and \
+                   scatter_cp <= stop_scatter:
+                return
+        else:
+            todo.append(i)
+    coords = todo
+    if not len(coords):
+        return
+    if stop_scatter is None:
+        source_thread.parallel = parallel_function(source_thread,ncpu,io=ioslots,\
+                                                   need=NDPPP_NEED)
+        parallel_result = source_thread.parallel(coords)
+        return
+    # search mode: at most ncpu candidates in flight, in the given order,
+    # and none started once one has a scatter at or below stop_scatter
+    for i,scatter_cp in schedule(source_thread,coords,cores=ncpu,io=ioslots,need=NDPPP_NEED,\
+                          stop=lambda s: s is not None and s <= stop_scatter):
+        pass
+
+def main( ms_input, lotss_file, ncpu=10, datacol='DATA', nsbs=20, screen=False, prescreen=None, progressive=False, search=None, ioslots=None ):
 
     ncpu = int(ncpu)
+    ioslots = int(ioslots) if ioslots else ncpu
     datacol = str(datacol)
     nsbs = int(nsbs)
 
@@ -297,14 +606,38 @@ def main( ms_input, lotss_file, ncpu=10, datacol='DATA', nsbs=20 ):
 	nsbs = len(mslist)
     mslist = mslist[0:nsbs]
     print mslist
-    global inarray
+    global inarray, PRESCREEN, RUNSTAMP
     inarray = mslist
+    if prescreen is not None:
+        PRESCREEN = float(prescreen)
+    RUNSTAMP = run_fingerprint( mslist )
     coords = lotss2coords( lotss_file )
+    if screen or progressive:
+        # one read of the subbands for all directions, no shifted MSs
+        t_start = time.time()
+        if progressive:
+            scatter,nsbused = progressive_screen( mslist, coords, datacol=datacol, tstep=TSTEP )
+        else:
+            scatter = screen_sources( mslist, coords, datacol=datacol, tstep=TSTEP )
+            nsbused = [len([ms for ms in mslist if os.path.isdir(ms)])]*len(coords)
+        for coord,scatter_cp,nsb in zip(coords,scatter,nsbused):
+            write_scatter(coord.split(',')[-1],scatter_cp,coord=coord,nsubbands=nsb,\
+                          mode='progressive' if progressive else 'screen',\
+                          t_start=t_start)
+        return
+    if search is not None:
+        # brightest, most compact candidates first; stop at a good one
+        coords = coords[np.argsort(-candidate_priority(lotss_file),kind='mergesort')]
+    # subband metadata (and difmap_select) once, rather than in every worker
+    index = build_subband_index( mslist )
+    fo = open('difmap_select','w')
+    fo.write(index['difmap_select'])
+    fo.close()
     tmp = []
     for coord in coords:
 	tmp.append( ';'.join([datacol,coord]) )
     coords = tmp
-    source( coords, ncpu )
+    source( coords, ncpu, stop_scatter=search, ioslots=ioslots )
 
 
 if __name__ == "__main__":
@@ -313,10 +646,15 @@ if __name__ == "__main__":
     parser.add_argument('MS_pattern',type=str, help='pattern to search for MS')
     parser.add_argument('lotss_file',type=str,help='catalogue to process')
     parser.add_argument('--ncpu',type=int,help='number of CPUs')
+    parser.add_argument('--ioslots',type=int,help='number of NDPPP runs reading the data at the same time (default: ncpu)',default=None)
     parser.add_argument('--datacol',type=str,help='datacolumn to use (default DATA)',default='DATA')
     parser.add_argument('--nsbs',type=int,help='number of subbands, default 20, use -1 for all',default=20)
+    parser.add_argument('--screen',action='store_true',help='phase-shift all directions in one read of the data instead of running NDPPP per direction')
+    parser.add_argument('--prescreen',type=float,help='only make the shifted MS of directions whose in-memory triangle closure scatter is below this (default: no pre-screen)',default=None)
+    parser.add_argument('--progressive',action='store_true',help='screen as --screen, starting on a few subbands and adding more (up to nsbs) only for directions that are neither clearly random nor clearly coherent')
+    parser.add_argument('--search',type=float,help='process candidates in order of expected signal and start no more once one has a closure scatter below this',default=None)
     args = parser.parse_args()
 
     MS_input = glob.glob( args.MS_pattern )
 
-    main( MS_input, args.lotss_file, ncpu=args.ncpu, datacol=args.datacol, nsbs=args.nsbs )
+    main( MS_input, args.lotss_file, ncpu=args.ncpu, datacol=args.datacol, nsbs=args.nsbs, screen=args.screen, prescreen=args.prescreen, progressive=args.progressive, search=args.search, ioslots=args.ioslots )
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import os,tempfile,numpy as np
+from crossmatch import sepn_deg
+
+# Declination-zoned index of the FIRST catalogue (first_2008.simple.npy:
+# one row per source, RA and Dec in degrees in the first two columns).
+# Built once next to the catalogue (or in the current directory if that is
+# not writable): the rows sorted by Dec, and the first row of each Dec zone
+# of ZONE degrees. Both are opened with mmap_mode, so a cone search reads
+# only the zones it overlaps, not the whole catalogue.
+
+ZONE = 0.1           # zone height in degrees
+
+def index_names(firstnpy):
+    base = os.path.splitext(os.path.basename(firstnpy))[0]
+    names = []
+    for d in (os.path.dirname(os.path.abspath(firstnpy)),os.getcwd()):
+        names.append((os.path.join(d,base+'_decsort.npy'),\
+                      os.path.join(d,base+'_zones.npy')))
+    return names
+
+# Write an array to a temporary file next to name and rename it into place,
+# so that a parallel run never opens a partly written file
+
+def save_atomic(name,a):
+    fd,tmpname = tempfile.mkstemp(suffix='.npy',dir=os.path.dirname(name))
+    try:
+        with os.fdopen(fd,'wb') as f:
+            np.save(f,a)
+        os.rename(tmpname,name)
+    except:
+        os.remove(tmpname)
+        raise
+
+def build_first_index(firstnpy,zone=ZONE):
+    first = np.load(firstnpy)
+    first = first[np.argsort(first[:,1],kind='mergesort')]
+    edges = -90.0+zone*np.arange(int(np.ceil(180.0/zone))+1)
+    zones = np.searchsorted(first[:,1],edges)
+    zones[-1] = len(first)
+    for sortname,zonename in index_names(firstnpy):
+        try:
+            save_atomic(sortname,first)     # rows first: the zone file
+            save_atomic(zonename,np.append(zones,zone))   # marks it complete
+            return sortname,zonename
+        except (IOError,OSError):
+            continue
+    raise IOError('Cannot write FIRST index for %s'%firstnpy)
+
+# Memory-mapped (rows, zone offsets, zone size), building the index if it
+# is missing or older than the catalogue
+
+def open_first_index(firstnpy):
+    mtime = os.path.getmtime(firstnpy)
+    for sortname,zonename in index_names(firstnpy):
+        if os.path.exists(zonename) and os.path.getmtime(zonename) >= mtime:
+            break
+    else:
+        sortname,zonename = build_first_index(firstnpy)
+    zones = np.load(zonename)
+    return np.load(sortname,mmap_mode='r'),zones[:-1].astype('int'),zones[-1]
+
+# FIRST sources within r degrees of (ra,dec): their rows (a copy, in RA
+# order like the catalogue) and separations in degrees
+
+def first_near(firstnpy,ra,dec,r):
+    rows,zones,zone = open_first_index(firstnpy)
+    z0 = max(0,int(np.floor((dec-r+90.0)/zone)))
+    z1 = min(len(zones)-1,int(np.floor((dec+r+90.0)/zone))+1)
+    cand = np.array(rows[zones[z0]:zones[z1]])
+    cand = cand[abs(cand[:,1]-dec) <= r]
+    sep = sepn_deg(ra,dec,cand[:,0],cand[:,1])
+    keep = np.argwhere(sep <= r)[:,0]
+    keep = keep[np.argsort(cand[keep,0],kind='mergesort')]
+    return cand[keep],sep[keep]
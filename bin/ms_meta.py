@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import os,numpy as np
+import pyrap.tables as pt
+
+# In-process metadata of measurement sets, replacing the taql subprocesses.
+# The SPECTRAL_WINDOW, FIELD and ANTENNA subtables of a MS are each opened
+# once with casacore; what is read is kept, keyed by the MS path and the
+# modification time of its directory (so a MS rewritten under the same name
+# is read again), for the rest of the process, so repeated lookups do not
+# touch the disk.
+
+MSMETA = {}
+
+# Columns of a subtable, array columns as one array per row (rows need not
+# have the same shape, e.g. spectral windows with different channel counts)
+
+def read_subtable(vis,subtable,columns):
+    t = pt.table(os.path.join(vis,subtable),ack=False)
+    try:
+        cols = {}
+        for c in columns:
+            if c not in t.colnames():
+                continue
+            if t.isscalarcol(c):
+                cols[c] = t.getcol(c)
+            else:
+                cols[c] = [np.asarray(t.getcell(c,i)) for i in range(t.nrows())]
+        return cols
+    finally:
+        t.close()
+
+# Dict of the metadata of a MS:
+#   chan_freq, chan_width  all channels of all spectral windows (Hz)
+#   ref_freq, num_chan     per spectral window
+#   phase_dir              (ra, dec) in radians of the (last) field
+#   antennas               antenna names; the STATION column if NAME is
+#                          just numbers (e.g. written by AIPS)
+
+def ms_meta(vis):
+    key = (os.path.abspath(vis),os.path.getmtime(vis))
+    if key in MSMETA:
+        return MSMETA[key]
+    spw = read_subtable(vis,'SPECTRAL_WINDOW',\
+                        ['CHAN_FREQ','CHAN_WIDTH','REF_FREQUENCY','NUM_CHAN'])
+    field = read_subtable(vis,'FIELD',['PHASE_DIR'])
+    ant = read_subtable(vis,'ANTENNA',['NAME','STATION'])
+    names = ant['NAME']
+    try:
+        int(names[0])
+        names = ant['STATION']
+    except ValueError:
+        pass
+    ra,dec = np.ravel(field['PHASE_DIR'][-1])[:2]
+    MSMETA[key] = {'chan_freq':np.concatenate(spw['CHAN_FREQ']),\
+                   'chan_width':np.concatenate(spw['CHAN_WIDTH']),\
+                   'ref_freq':np.asarray(spw['REF_FREQUENCY']),\
+                   'num_chan':np.asarray(spw['NUM_CHAN']),\
+                   'phase_dir':np.array([ra%(2.0*np.pi),dec]),\
+                   'antennas':np.asarray(names)}
+    return MSMETA[key]
+
+def ms_antenna_names(vis):
+    return ms_meta(vis)['antennas']
+
+def ms_phase_centre(vis):
+    return ms_meta(vis)['phase_dir']
+
+# Index numbers (offsets from 0) of telescopes, given as antenna names or
+# their prefixes. Returns [] and prints the antennas present if any is
+# missing.
+
+def ms_idx_tels(vis,tel):
+    names = ms_antenna_names(vis)
+    idx_tels = [-1]*len(tel)
+    for j in range(len(names)):
+        for i in range(len(tel)):
+            if tel[i]==names[j][:len(tel[i])]:
+                idx_tels[i] = j
+    if -1 in idx_tels:
+        print '\n'.join(names)
+        print 'Did not find one or more of the telescopes'
+        print 'Telescopes present are those in list above'
+        return []
+    return idx_tels
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+import os,time,socket,sqlite3
+
+# Store of closure-phase results, shared by the workers that evaluate
+# candidate directions. SQLite in WAL mode: every record is its own
+# transaction, so parallel writers never interleave and readers do not
+# block them. Kept next to closure_phases.txt, which is still written for
+# older readers. The done table holds one completion marker per direction,
+# with a fingerprint of its inputs, so that a restarted run can skip it.
+
+RESULTS_DB = 'closure_phases.db'
+TIMEOUT = 60.0       # seconds to wait for another writer's lock
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    direction TEXT NOT NULL,
+    source_id TEXT,
+    ra REAL,
+    dec REAL,
+    triangle TEXT,
+    scatter REAL,
+    nsubbands INTEGER,
+    mode TEXT,
+    t_start REAL,
+    t_end REAL,
+    host TEXT,
+    pid INTEGER)'''
+DONE_SCHEMA = '''CREATE TABLE IF NOT EXISTS done (
+    direction TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    scatter REAL,
+    t_end REAL)'''
+INDEXES = ['CREATE INDEX IF NOT EXISTS results_scatter ON results (scatter)',
+           'CREATE INDEX IF NOT EXISTS results_direction ON results (direction)']
+
+def connect(dbfile=RESULTS_DB):
+    con = sqlite3.connect(dbfile,timeout=TIMEOUT)
+    con.execute('PRAGMA journal_mode=WAL')
+    with con:
+        con.execute(SCHEMA)
+        con.execute(DONE_SCHEMA)
+        for idx in INDEXES:
+            con.execute(idx)
+    return con
+
+# Add one result. NaN scatters (no data) are stored as NULL.
+
+def put_result(direction,scatter,source_id=None,ra=None,dec=None,triangle='',\
+               nsubbands=None,mode='',t_start=None,t_end=None,dbfile=RESULTS_DB):
+    scatter = None if scatter is None or scatter!=scatter else float(scatter)
+    ra,dec = [None if x is None else float(x) for x in (ra,dec)]
+    nsubbands = None if nsubbands is None else int(nsubbands)
+    t_end = time.time() if t_end is None else t_end
+    con = connect(dbfile)
+    try:
+        with con:
+            con.execute('INSERT INTO results (direction,source_id,ra,dec,'
+                        'triangle,scatter,nsubbands,mode,t_start,t_end,host,'
+                        'pid) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',\
+                        (direction,source_id or direction,ra,dec,triangle,\
+                         scatter,nsubbands,mode,t_start,t_end,\
+                         socket.gethostname(),os.getpid()))
+    finally:
+        con.close()
+
+# Completion marker of a direction, replacing any earlier one
+
+def mark_done(direction,fingerprint,scatter,dbfile=RESULTS_DB):
+    scatter = None if scatter is None or scatter!=scatter else float(scatter)
+    con = connect(dbfile)
+    try:
+        with con:
+            con.execute('INSERT OR REPLACE INTO done (direction,fingerprint,'
+                        'scatter,t_end) VALUES (?,?,?,?)',\
+                        (direction,fingerprint,scatter,time.time()))
+    finally:
+        con.close()
+
+# Dict of direction: (fingerprint, scatter) of the finished directions
+
+def get_done(dbfile=RESULTS_DB):
+    if not os.path.exists(dbfile):
+        return {}
+    con = connect(dbfile)
+    try:
+        rows = con.execute('SELECT direction,fingerprint,scatter FROM done').fetchall()
+    finally:
+        con.close()
+    return dict([(str(r[0]),(str(r[1]),r[2])) for r in rows])
+
+# Result with the lowest scatter, as a dict, or None if there is none
+
+def best_result(dbfile=RESULTS_DB):
+    if not os.path.exists(dbfile):
+        return None
+    con = connect(dbfile)
+    con.row_factory = sqlite3.Row
+    try:
+        row = con.execute('SELECT * FROM results WHERE scatter IS NOT NULL '
+                          'ORDER BY scatter LIMIT 1').fetchone()
+    finally:
+        con.close()
+    return None if row is None else dict(zip(row.keys(),row))
@@ -3,12 +3,14 @@ import numpy as np
 import os
 import sys
 import glob
-import astropy
+import astropy.coordinates
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib
 from matplotlib import pyplot as plt
 import time
+import shutil
+import tempfile
 import pyrap.tables as pt
 # neal specific
 import scipy
@@ -16,7 +18,11 @@ from scipy import fftpack as ff
 import warnings
 import multiprocessing
 from scipy import ndimage,optimize
-from astropy.coordinates import SkyCoord
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from closure_v4 import closure_phasors,baseline_reduce,cache_key,cache_get,cache_put
+from task_scheduler import parallel_function,schedule,nproc
+from first_index import first_near
+from ms_meta import ms_meta,ms_phase_centre,ms_idx_tels
 
 
 # Requires:
@@ -36,107 +42,29 @@ from astropy.coordinates import SkyCoord
 # 4ch/8s 20Gb per source (FOV) 1ch/16s 3 GB/source to go to 5' fields
 # eor scripts gives out cal table as a lofar parmdb
 
-###################### taql_funcs ################################
-def taql_calc (vis, vistable, qtab, qtype):
-    visout = vis + '_taql_out'
-    os.system('taql \'CALC '+qtype+' ([select '+qtab+' from '+vis+\
-              '/'+vistable+'])\' >'+visout)
-    f=open(visout)
-    for v in f:
-        try:
-            val = float(v.rstrip('\n'))
-        except:
-            pass
-    f.close()
-    os.system('rm '+visout)
-    return val
-
-def taql_num (vis,vistable,qtab):
-    visout = vis + '_taql_out'
-    os.system('taql \'select '+qtab+' from '+vis+'/'+vistable+'\' >'+visout)
-    f=open(visout)
-    for v in f:
-        if 'select result of' in v:
-            n = int(v.split('of')[1].split('row')[0])
-            break
-    f.close()
-    os.system('rm '+visout)
-    return n
-
-def taql_from (vis,vistable,qtab):
-    visout = vis + '_taql_out'
-    os.system('taql \'select '+qtab+' from '+vis+'/'+vistable+'\' >'+visout)
-    f = open(visout)
-    for v in f:
-        pass
-    f.close()
-    os.system('rm '+visout)
-    return v.rstrip('\n').rstrip(']').lstrip('[').split(',')
-
-################## idx_tels #############################
-
-
-# From a MS, return the index numbers of telescopes. Neal Jackson 03/17
-# Input telescopes given as an array of strings
-# Note that the index numbers are found in one of two places, the NAME and
-# STATION columns (latter if it has been written by AIPS, for instance), so
-# this routine deals with that too. NB returns the OFFSET (starts at 0) not
-# the AIPS telescope number (starts at 1) in this case.
-# Output is a list of indices of telescopes. Note that you need to use the
-# lower one first if reading data out of a MS.
-
-def get_idx_tels (data, tel):
-    dataout = data + '_closure_which'
-    os.system('taql \'select NAME from %s/ANTENNA\' >%s'%(data,dataout))
-    f = open(dataout)
-    for line in f:
-        if 'select' in line or not len(line.rstrip('\n')):
-            continue
-        try:
-            a = int(line) # it's just a number, use STATION column instead
-            f.close()
-            os.system('taql \'select STATION from %s/ANTENNA\' >%s'%(data,dataout))
-            break
-        except:
-            f.close()
-            break
-    idx_tels, iline = [-1]*len(tel), 0
-    f = open(dataout)
-    for line in f:
-        if not 'select' in line:
-            for i in range(len(tel)):
-                if tel[i]==line[:len(tel[i])]:
-                    idx_tels[i] = iline
-            iline += 1
-    f.close()
-    if -1 in idx_tels:
-        os.system('cat %s'%dataout)
-        print 'Did not find one or more of the telescopes'
-        print 'Telescopes present are those in list above'
-        return []
-    os.system('rm %s'%dataout)
-    return idx_tels
-
 ################## mkgauss ##############################
 
-def mkgauss (naxes,pos,flux,fwhm,axrat=1.0,angle=0.0,ignore=4.0,dodist=False):
-# note that total flux = peak flux in a pixel * 1.1331*FWHM**2
-# angle is major axis East of North
-    a = np.zeros (naxes[0]*naxes[1]).reshape(naxes[1],naxes[0])
+# Elliptical Gaussian over the box of pixels within ignore*fwhm of pos
+# (for a circular Gaussian only those within that radius, the rest of the
+# box being 0). Returns the row and column ranges of the box and the
+# values (or distances, if dodist) in it.
+def gauss_box (naxes,pos,flux,fwhm,axrat=1.0,angle=0.0,ignore=4.0,dodist=False):
     fwhm /= 1.66667
+    rad = ignore*fwhm
+    i0 = max(0,int(np.ceil(pos[1]-rad)))
+    j0 = max(0,int(np.ceil(pos[0]-rad)))
+    i1 = max(i0,min(naxes[1],int(np.floor(pos[1]+rad))+1))   # empty if off
+    j1 = max(j0,min(naxes[0],int(np.floor(pos[0]+rad))+1))   # the grid
+    ydist = (np.arange(i0,i1,dtype=float)-pos[1])[:,None]
+    xdist = (np.arange(j0,j1,dtype=float)-pos[0])[None,:]
     if axrat==1.0 and angle==0.0:
-        for i in range (naxes[1]):
-            ydist=float(i)-pos[1]
-            for j in range (naxes[0]):
-                xdist=float(j)-pos[0]
-                if xdist*xdist+ydist*ydist>ignore*ignore*fwhm*fwhm:
-                    continue
-                if not dodist:
-                    a[i,j] = flux*np.exp(-(xdist*xdist+ydist*ydist)/ \
-                                    (fwhm*fwhm))/(fwhm*fwhm*np.pi)
-                else:
-                    a[i,j] = np.hypot(xdist,ydist)
-        return a
+        r2 = xdist*xdist+ydist*ydist
+        if not dodist:
+            a = flux*np.exp(-r2/(fwhm*fwhm))/(fwhm*fwhm*np.pi)
+        else:
+            a = np.sqrt(r2)
+        a[r2>rad*rad] = 0.0
+        return i0,i1,j0,j1,a
     sinth = np.sin(angle*np.pi/180.0)
     costh = np.cos(angle*np.pi/180.0)
     r = np.array([-sinth,costh,-costh,-sinth])
@@ -145,23 +73,43 @@ def mkgauss (naxes,pos,flux,fwhm,axrat=1.0,angle=0.0,ignore=4.0,dodist=False):
     scr1 = mxmul (sig,r)
     scr2 = mxmul (rt, scr1)
     scr1 = mxinv (scr2)
-    for i in range(naxes[1]):
-        ydist=float(i)-pos[1]
-        if abs(ydist)>ignore*fwhm:
-            continue
-        for j in range (naxes[0]):
-            xdist = float(j) - pos[0]
-            if abs(xdist)>ignore*fwhm:
-                continue
-            ex = scr1[0]*xdist+scr1[1]*ydist
-            ey = scr1[2]*xdist+scr1[3]*ydist
-            if not dodist:
-                a[i,j] = (flux/axrat)*np.exp(-(ex*ex+ey*ey))/(fwhm*fwhm*np.pi)
-            else:
-                a[i,j] = np.hypot(ex,ey)/1.6666667
+    ex = scr1[0]*xdist+scr1[1]*ydist
+    ey = scr1[2]*xdist+scr1[3]*ydist
+    if not dodist:
+        a = (flux/axrat)*np.exp(-(ex*ex+ey*ey))/(fwhm*fwhm*np.pi)
+    else:
+        a = np.hypot(ex,ey)/1.6666667
+    return i0,i1,j0,j1,a
 
+def mkgauss (naxes,pos,flux,fwhm,axrat=1.0,angle=0.0,ignore=4.0,dodist=False):
+# note that total flux = peak flux in a pixel * 1.1331*FWHM**2
+# angle is major axis East of North
+    a = np.zeros (naxes[0]*naxes[1]).reshape(naxes[1],naxes[0])
+    i0,i1,j0,j1,box = gauss_box (naxes,pos,flux,fwhm,axrat,angle,ignore,dodist)
+    a[i0:i1,j0:j1] = box
     return a
 
+# Render many Gaussians (pos is nsrc x 2, the others scalars or one per
+# source) into one grid. Returns their sum; or, if labels (a grid) is
+# given, writes into it the number of each source where that source is
+# above labthresh times its peak (later sources overwrite earlier ones)
+# and returns it.
+def mkgauss_many (naxes,pos,flux,fwhm,axrat=1.0,angle=0.0,ignore=4.0,\
+                  labels=None,labthresh=0.004):
+    pos = np.atleast_2d(pos)
+    nsrc = len(pos)
+    flux,fwhm,axrat,angle = [np.resize(np.asarray(x,dtype=float),nsrc) \
+                             for x in (flux,fwhm,axrat,angle)]
+    out = np.zeros((naxes[1],naxes[0])) if labels is None else labels
+    for k in range(nsrc):
+        i0,i1,j0,j1,box = gauss_box (naxes,pos[k],flux[k],fwhm[k],axrat[k],\
+                                     angle[k],ignore)
+        if labels is None:
+            out[i0:i1,j0:j1] += box
+        elif box.size:
+            np.putmask(out[i0:i1,j0:j1],box>labthresh*box.max(),k)
+    return out
+
 def mxmul(a,b):
     output=np.zeros(4)
     output[0]=a[0]*b[0]+a[1]*b[2]
@@ -182,81 +130,30 @@ def mxinv(a):
 
 def closure (vis, tel, lastv=-1, plotfile='clplot.png'):
     # Find which number is which antenna
-    itels = np.sort(get_idx_tels (vis, tel))
+    itels = np.sort(ms_idx_tels (vis, tel))
     if itels == []:
         return -1
 
-    # Make three reference MSs with pointers
+    # Reduce the three baselines to channel-summed visibilities per time,
+    # unless this triangle of this MS is already in the closure cache
     print 'itels',itels
-    d1,ut1,uvw = dget_t (vis,itels[0],itels[1])
-    d2,ut2,uvw = dget_t (vis,itels[1],itels[2])
-    d3,ut3,uvw = dget_t (vis,itels[0],itels[2])
-    a1,p1 = getap(d1[:lastv])
-    a2,p2 = getap(d2[:lastv])
-    a3,p3 = getap(d3[:lastv])
-    clph = p1+p2-p3
-    np.putmask(clph,clph>np.pi,clph-2*np.pi)
-    np.putmask(clph,clph<-np.pi,clph+2*np.pi)
+    key = cache_key(vis,itels,0,'all',0,-1,lastv,stat='skynet_closure')
+    hit = cache_get(key)
+    if hit is not None:
+        scatter,clph = hit
+    else:
+        v1,a1,ut1,uvw = dget_ap (vis,itels[0],itels[1])
+        v2,a2,ut2,uvw = dget_ap (vis,itels[1],itels[2])
+        v3,a3,ut3,uvw = dget_ap (vis,itels[0],itels[2])
+        clph = closure_phasors(v1[:lastv],v2[:lastv],v3[:lastv])
+        clph = clph[~np.isnan(clph)]
+        scatter = np.nanmean(np.gradient(np.unwrap(clph))**2)
+        cache_put(key,scatter,clph)
     # return a statistic - is 1.64 for random closure phase, less for coherent
     if len(plotfile):
         plt.plot(clph,'b+')
         plt.savefig(plotfile)
-    return np.nanmean(np.gradient(np.unwrap(clph))**2)
-
-################### correlate ##########################
-
-def astropy_sep (tra1,tdec1,tra2,tdec2):
-    sc1 = SkyCoord(tra1, tdec1, frame = 'fk5', unit='degree')
-    sc2 = SkyCoord(tra2, tdec2, frame = 'fk5', unit = 'degree')
-    return((sc1.separation(sc2)).degree)
-
-# correlate two arrays sorted in ra. array2 is the bigger one.
-
-def correlate (array1, ra1, dec1, array2, ra2, dec2, dist, \
-               mindist=0.0, isabs=False, noisy=True):
-    fstart=nfstart=0
-    fend=array2.shape[0]
-    icou=0
-    correl=np.array([])
-    decfac=1.0 if isabs else min(1./np.cos(np.deg2rad(array1[:,dec1].max())),\
-               1./np.cos(np.deg2rad(array2[:,dec2].max())))
-
-    for i in range(array1.shape[0]):
-        i10 = np.linspace(0,array1.shape[0],10,dtype='int')
-        i100 = np.linspace(0,array1.shape[0],100,dtype='int')
-        if i in i10 and noisy:
-            sys.stdout.write('*')
-            sys.stdout.flush()
-        elif i in i100 and noisy:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        else:
-            pass
-        fstart=nfstart
-        for j in range(fstart,fend):
-            r1,d1 = array1[i,ra1],array1[i,dec1]
-            r2,d2 = array2[j,ra2],array2[j,dec2]
-            radiff = r2-r1
-            if radiff<-decfac*dist:
-                nfstart=j
-            if radiff>decfac*dist:
-                break
-            if abs(d2-d1)>dist:
-                continue
-            if isabs:
-                adist = np.hypot(r1-r2,d1-d2)
-            else:
-		adist = astropy_sep(r1,d2,r2,d2)
-
-            if adist<dist and abs(radiff)<90.0 and adist>=mindist:
-                try:
-                    correl=np.vstack((correl,np.array([i,j,adist])))
-                except:
-                    correl=np.array([[i,j,adist]])
-
-    return correl
-
-
+    return scatter
 
 ################## model_engine ########################
 
@@ -275,6 +172,14 @@ LIGHT = 2.99792458E+8
 #FIRSTNPY = './first_2008.simple.npy'
 MX,MY,MF,MW,MR,MP = range(6)
 ISPARALLEL = int(os.popen('nproc').read())>4
+UVDTYPE = 'float64'       # model prediction precision, float32 for speed
+GRIDBLOCK = 2000000       # grid positions x samples predicted at once
+GRIDCOARSE = 4            # pixel step of the first level of the grid search
+GRIDKEEP = 0.02           # fraction of best cells refined at each level
+GRIDKEEPMIN = 30          # but at least this many
+FITMODE = 'gradient'      # refine_points/adjust_all: 'gradient' (L-BFGS-B) or 'simplex'
+# observed data of the triangle, memory-mapped read-only by data_extract
+ENGINEDATA = ['uvw01','uvw02','uvw12','cp012','a01','a02','a12','uvp01','uvp02','uvp12']
 
 # Make a movie from a set of png files
 def movie (fps=4):
@@ -285,43 +190,76 @@ def movie (fps=4):
     os.system(command)
     os.system('rm model_engine*.jpeg')
 
-# Work out real and imaginary parts of a list of visibilities given model and uvw's
-def uvw2reim (uvw, model):
-    u,v,re,im = uvw[:,0],uvw[:,1],0.,0.
-    for m in model:     # note - sign in m[MX] as this is HA not RA
-        cmpamp,cmpphs = m[MF],2.*np.pi*(-u*m[MX]+v*m[MY])/RAD2ARC
-        if m[MW]!=0.0:
-            sphi,cphi = np.sin(np.deg2rad(m[MP])),np.cos(np.deg2rad(m[MP]))
-            tc = np.pi*(m[MW]/RAD2ARC)*np.hypot(v*cphi+u*sphi,m[MR]*(u*cphi-v*sphi))
-            cmpamp = m[MF]*np.exp(-0.3696737602*tc*tc)
-        re += cmpamp * np.cos(cmpphs)
-        im += cmpamp * np.sin(cmpphs)
-    return re,im
-
-def dget_t (vis, tel1, tel2):
-    visout = vis + '.tmp'
-    os.system('taql \'select from %s where ANTENNA1==%d and ANTENNA2==%d giving %s\'' % (vis, tel1, tel2, visout))
-    t = pt.table(visout)
-    ut = np.ravel(np.asarray([tuple(each.values()) for each in t.select('TIME')]))
-    spw = np.ravel(np.asarray([tuple(each.values()) for each in t.select('DATA_DESC_ID')]))
-    dc = t.select('DATA')
-    d = np.asarray([tuple(each.values()) for each in dc])[:,0,:,:]
-    d = np.swapaxes(d,0,2)     # makes the order pol - chan - time as in casa
-    for u in t.select('UVW'):
-        try:
-            uvw = np.vstack ((uvw,u['UVW']))
-        except:
-            uvw = np.copy(u['UVW'])
-    if spw.sum():
-        for i in np.unique(spw):
-            new = np.take(d,np.argwhere(spw==i),axis=2)[:,:,:,0]
-            try:
-                d_out = np.concatenate((d_out,new),axis=1)
-            except:
-                d_out = np.copy(new)
-        d = d_out
-    os.system('rm -r %s'%visout)
-    return d,ut,uvw
+# u,v of a baseline (in wavelengths) scaled by 2pi/RAD2ARC, so that a
+# position in arcsec times u gives a phase in radians; computed once per
+# baseline (in data_extract) rather than in every model evaluation
+def uv_prep (uvw, dtype=UVDTYPE):
+    return (2.*np.pi/RAD2ARC*np.asarray(uvw)[:,:2]).astype(dtype)
+
+# Complex visibilities of a list of uvw's given the model, all components
+# at once: phases and Gaussian tapers are (component x sample) arrays
+# summed over components. dtype float32 gives a complex64 result, and is
+# several times faster. uvp is uv_prep(uvw) if already known.
+def uvw2vis (uvw, model, dtype=UVDTYPE, uvp=None):
+    uvp = uv_prep(uvw,dtype) if uvp is None else uvp
+    m = np.asarray(model,dtype=dtype).reshape(-1,6)
+    u,v = uvp[:,0],uvp[:,1]
+    # note - sign in m[MX] as this is HA not RA
+    phs = np.outer(-m[:,MX],u)+np.outer(m[:,MY],v)
+    amp = np.repeat(m[:,MF,None],len(u),axis=1)
+    ext = m[:,MW]!=0.0
+    if ext.any():
+        e = m[ext]
+        sphi,cphi = np.sin(np.deg2rad(e[:,MP,None])),np.cos(np.deg2rad(e[:,MP,None]))
+        tc = 0.5*e[:,MW,None]*np.hypot(v*cphi+u*sphi,e[:,MR,None]*(u*cphi-v*sphi))
+        amp[ext] = e[:,MF,None]*np.exp(-0.3696737602*tc*tc)
+    vis = np.empty(len(u),dtype=np.result_type(dtype,np.complex64))
+    vis.real = (amp*np.cos(phs)).sum(axis=0)   # cos/sin vectorise (SIMD)
+    vis.imag = (amp*np.sin(phs)).sum(axis=0)   # better than complex exp
+    return vis
+
+# As uvw2vis (always in double precision), also returning the derivatives
+# of the visibilities with respect to each parameter of each component, as
+# a (component x 6 x sample) array in the order MX,MY,MF,MW,MR,MP (MP per
+# degree). Point components (MW 0) have no MW,MR,MP derivatives.
+def uvw2vis_grad (uvw, model, uvp=None):
+    uvp = uv_prep(uvw,'float64') if uvp is None else np.asarray(uvp,dtype='float64')
+    m = np.asarray(model,dtype='float64').reshape(-1,6)
+    u,v = uvp[:,0],uvp[:,1]
+    phs = np.outer(-m[:,MX],u)+np.outer(m[:,MY],v)
+    taper = np.ones((len(m),len(u)))
+    dlog = np.zeros((len(m),3,len(u)))    # d log(taper) / d MW,MR,MP
+    ext = m[:,MW]!=0.0
+    if ext.any():
+        e = m[ext]
+        sphi,cphi = np.sin(np.deg2rad(e[:,MP,None])),np.cos(np.deg2rad(e[:,MP,None]))
+        p,q = v*cphi+u*sphi,u*cphi-v*sphi
+        w,r = e[:,MW,None],e[:,MR,None]
+        tc2 = 0.25*w*w*(p*p+r*r*q*q)
+        taper[ext] = np.exp(-0.3696737602*tc2)
+        dlog[ext,0] = -0.3696737602*2.*tc2/w
+        dlog[ext,1] = -0.3696737602*0.5*w*w*r*q*q
+        dlog[ext,2] = -0.3696737602*0.5*w*w*p*q*(1.-r*r)*np.pi/180.
+    cvis = taper*(np.cos(phs)+1j*np.sin(phs))   # unit-flux visibility per cpt
+    dvis = np.empty((len(m),6,len(u)),dtype='complex')
+    dvis[:,MX] = -1j*u*m[:,MF,None]*cvis
+    dvis[:,MY] = 1j*v*m[:,MF,None]*cvis
+    dvis[:,MF] = cvis
+    dvis[:,MW:] = m[:,MF,None,None]*cvis[:,None]*dlog
+    return (m[:,MF,None]*cvis).sum(axis=0),dvis
+
+# Read one baseline of a MS in blocks of rows and reduce it as it is read
+# to one value per time: channel-summed visibility of pol (all spectral
+# windows added), mean amplitude over channels, time and uvw. Replaces
+# dget_t, which made a temporary MS and built the whole DATA array of the
+# baseline through a Python tuple per row.
+def dget_ap (vis, tel1, tel2, pol=0):
+    t = pt.table(vis, ack=False)
+    tb = t.query('ANTENNA1==%d && ANTENNA2==%d' % (tel1, tel2))
+    ut,vsum,asum,nsum,uvw = baseline_reduce(tb,pol=pol)
+    tb.close()
+    t.close()
+    return vsum,asum/nsum,ut,uvw
 
 def norm(a,isred=True):
     nlim = np.pi
@@ -330,10 +268,6 @@ def norm(a,isred=True):
     np.putmask(a,a<-nlim,a+2.*nlim)
     return a
 
-def getap (d,pol=0):
-    ph = np.sum(d[pol],axis=0)
-    return np.sum(abs(d[pol]),axis=0)/d.shape[1],np.arctan2(ph.imag,ph.real)
-
 def get_uvw_table (t):
     for u in t.select('UVW'):
         try:
@@ -344,34 +278,31 @@ def get_uvw_table (t):
 
 # Get data and u-v arrays from a measurement set on a given triangle
 def data_extract (vis):
-    global uvw01,uvw02,uvw12,cp012,a01,a02,a12
-    chw = taql_calc(vis,'SPECTRAL_WINDOW','CHAN_WIDTH','mean')
-    ch0 = taql_calc(vis,'SPECTRAL_WINDOW','REF_FREQUENCY','mean')
-    nchan = taql_calc(vis,'SPECTRAL_WINDOW','NUM_CHAN','mean')
-    sra,sdec = taql_from(vis,'FIELD','PHASE_DIR')
-    nspw = taql_num(vis,'SPECTRAL_WINDOW','NUM_CHAN')
-    sra = np.asarray(sra.replace('h',' ').replace('m',' ').split(),dtype='f')
-    sdec = np.asarray(sdec.replace('d',' ').replace('m',' ').split(),dtype='f')
-    ra = 15.0*(sra[0]+sra[1]/60.0+sra[2]/3600.0)
-    dec = np.sign(sdec[0]) * ( np.abs(sdec[0])+sdec[1]/60.0+sdec[2]/3600.0 )
-    wlength = np.mean(LIGHT/(ch0 + chw*np.arange(nspw*nchan)))
-    itel = np.array(get_idx_tels (vis,trname))
+    global uvw01,uvw02,uvw12,cp012,a01,a02,a12,uvp01,uvp02,uvp12
+    meta = ms_meta(vis)
+    chw = np.mean(meta['chan_width'])
+    ch0 = np.mean(meta['ref_freq'])
+    nchan = np.mean(meta['num_chan'])
+    nspw = len(meta['num_chan'])
+    ra,dec = np.rad2deg(meta['phase_dir'])
+    wlength = np.mean(LIGHT/(ch0 + chw*np.arange(int(nspw*nchan))))
+    itel = np.array(ms_idx_tels (vis,trname))
     # order of telescopes on baselines 0-1, 0-2, 1-2; -1 if in "wrong" order
     otel = 1.-2.*np.asarray([itel[0]>itel[1],itel[0]>itel[2],itel[1]>itel[2]],dtype=float)
     btel = [min(itel[0],itel[1]),max(itel[0],itel[1]),min(itel[0],itel[2]),\
             max(itel[0],itel[2]),min(itel[1],itel[2]),max(itel[1],itel[2])]
-    d01,ut01,uvw01 = dget_t (vis, btel[0],btel[1])
-    d02,ut02,uvw02 = dget_t (vis, btel[2],btel[3])
-    d12,ut12,uvw12 = dget_t (vis, btel[4],btel[5])
-    a01,p01 = getap(d01)
-    a02,p02 = getap(d02)
-    a12,p12 = getap(d12)
+    v01,a01,ut01,uvw01 = dget_ap (vis, btel[0],btel[1])
+    v02,a02,ut02,uvw02 = dget_ap (vis, btel[2],btel[3])
+    v12,a12,ut12,uvw12 = dget_ap (vis, btel[4],btel[5])
+    p01,p02,p12 = np.angle(v01),np.angle(v02),np.angle(v12)
     cp012 = otel[0]*p01-otel[1]*p02+otel[2]*p12
     np.putmask(cp012,cp012>np.pi,cp012-2*np.pi)
     np.putmask(cp012,cp012<-np.pi,cp012+2*np.pi)
     uvw01 /= wlength
     uvw02 /= wlength
     uvw12 /= wlength
+    uvp01,uvp02,uvp12 = [uv_prep(u,UVDTYPE) for u in (uvw01,uvw02,uvw12)]
+    share_data ()
     print trname,'-> antenna numbers:',itel
     print 'Baseline lengths: %s-%s: %dkm %s-%s: %dkm %s-%s: %dkm' % \
        (trname[0],trname[1],int(np.sqrt((uvw01[0]**2).sum())*wlength/1000),\
@@ -379,16 +310,70 @@ def data_extract (vis):
         trname[1],trname[2],int(np.sqrt((uvw12[0]**2).sum())*wlength/1000))
     return itel,np.mean(wlength),ra,dec
 
+# Move the observed data (ENGINEDATA globals) to .npy files in a scratch
+# directory and replace them by read-only memory maps of those files, so
+# that grid-search workers share the same pages instead of copying the
+# arrays they touch. Returns the directory; remove it when done.
+def share_data (scratch='.'):
+    global datadir
+    datadir = tempfile.mkdtemp(prefix='model_engine_data_',dir=scratch)
+    for name in ENGINEDATA:
+        fname = os.path.join(datadir,name+'.npy')
+        np.save(fname,globals()[name])
+        globals()[name] = np.load(fname,mmap_mode='r')
+    return datadir
+
 def model_extract (model,itel):
     otel = 1.-2.*np.asarray([itel[0]>itel[1],itel[0]>itel[2],itel[1]>itel[2]],dtype=float)
-    re01,im01 = uvw2reim (uvw01,model)
-    re12,im12 = uvw2reim (uvw12,model)
-    re02,im02 = uvw2reim (uvw02,model)
-    ph01 = norm(np.arctan2(im01,re01))
-    ph02 = norm(np.arctan2(im02,re02))
-    ph12 = norm(np.arctan2(im12,re12))
+    v01 = uvw2vis (uvw01,model,UVDTYPE,uvp01)
+    v12 = uvw2vis (uvw12,model,UVDTYPE,uvp12)
+    v02 = uvw2vis (uvw02,model,UVDTYPE,uvp02)
+    ph01 = norm(np.angle(v01))
+    ph02 = norm(np.angle(v02))
+    ph12 = norm(np.angle(v12))
+    clph = norm(ph01*otel[0] - ph02*otel[1] + ph12*otel[2])
+    return abs(v01),abs(v02),clph
+
+# As model_extract, also returning the derivatives of the amplitudes and
+# closure phase with respect to the (flattened) model parameters, as
+# (parameter x sample) arrays. Phase wraps are ignored.
+def model_extract_grad (model,itel):
+    otel = 1.-2.*np.asarray([itel[0]>itel[1],itel[0]>itel[2],itel[1]>itel[2]],dtype=float)
+    amp,ph,damp,dph = [],[],[],[]
+    for uvw,uvp in ((uvw01,uvp01),(uvw02,uvp02),(uvw12,uvp12)):
+        vis,dvis = uvw2vis_grad (uvw,model,uvp)
+        cdv = np.conj(vis)*dvis.reshape(-1,len(vis))
+        amp.append(abs(vis))
+        ph.append(norm(np.angle(vis)))
+        damp.append(cdv.real/abs(vis))
+        dph.append(cdv.imag/abs(vis)**2)
+    clph = norm(ph[0]*otel[0] - ph[1]*otel[1] + ph[2]*otel[2])
+    dclph = dph[0]*otel[0] - dph[1]*otel[1] + dph[2]*otel[2]
+    return amp[0],amp[1],clph,damp[0],damp[1],dclph
+
+# As model_extract for a whole block of positions pos (npos x 2, arcsec)
+# of component cpt, the rest of the model staying fixed. The fixed
+# components are predicted once; the moving one adds its (real, position-
+# independent) amplitude times a (positions x samples) phasor. Returns
+# (npos x samples) arrays.
+def model_extract_grid (model,cpt,pos,itel):
+    otel = 1.-2.*np.asarray([itel[0]>itel[1],itel[0]>itel[2],itel[1]>itel[2]],dtype=float)
+    fixed = np.delete(model,cpt,axis=0)
+    moving = np.copy(model[cpt:cpt+1])
+    moving[0,MX] = moving[0,MY] = 0.0
+    pos = np.asarray(pos,dtype=UVDTYPE)
+    vis = []
+    for uvw,uvp in ((uvw01,uvp01),(uvw02,uvp02),(uvw12,uvp12)):
+        vf = uvw2vis (uvw,fixed,UVDTYPE,uvp) if len(fixed) else 0.0
+        va = uvw2vis (uvw,moving,UVDTYPE,uvp).real
+        phs = np.outer(-pos[:,0],uvp[:,0])+np.outer(pos[:,1],uvp[:,1])
+        vis.append(vf+va*np.cos(phs)+1j*(va*np.sin(phs)))
+    v01,v02,v12 = vis
+    ph01 = norm(np.angle(v01))
+    ph02 = norm(np.angle(v02))
+    ph12 = norm(np.angle(v12))
     clph = norm(ph01*otel[0] - ph02*otel[1] + ph12*otel[2])
-    return np.hypot(re01,im01),np.hypot(re02,im02),clph
+    return abs(v01),abs(v02),clph
 
 def plotimg (A01,A02,CP012,model,goodness,itel,aplot,gcou):
     ells = []
@@ -452,23 +437,106 @@ def plotimg (A01,A02,CP012,model,goodness,itel,aplot,gcou):
     if plottype in [10,20]:
         plt.savefig('model_engine_%03d.png'%gcou)
 
+# Mean squared difference of b and a shifted by each lag from -n/2 to n/2-1
+# (as range(-n/2,n/2), rounding down), over the samples where they
+# overlap: sum(b^2)+sum(a^2)-2*sum(b*a) with the cross term for all lags
+# from one FFT cross-correlation and the other two from prefix sums, so
+# O(n log n) rather than O(n^2). a and b may have leading batch axes (they
+# are broadcast); lags are along the last axis.
 def ndiff (a,b):
-    sqd = np.array([])
-    for i in range(-len(a)/2,len(a)/2):
-        a1 = np.roll(a,i)
-        idx1,idx2 = max(0,i),min(len(a),len(a)+i)
-        sqd = np.append(sqd, np.mean(((b-a1)[idx1:idx2]**2)))
-    return sqd
-
+    a,b = np.asarray(a,dtype=float),np.asarray(b,dtype=float)
+    n = a.shape[-1]
+    lags = np.arange(-((n+1)//2),n//2)
+    nfft = 2**int(np.ceil(np.log2(2*n)))
+    cross = np.fft.irfft(np.fft.rfft(b,nfft)*np.conj(np.fft.rfft(a,nfft)),nfft)
+    cross = cross[...,lags%nfft]
+    zero = np.zeros(a.shape[:-1]+(1,))
+    pa = np.concatenate((zero,np.cumsum(a*a,axis=-1)),axis=-1)
+    zero = np.zeros(b.shape[:-1]+(1,))
+    pb = np.concatenate((zero,np.cumsum(b*b,axis=-1)),axis=-1)
+    idx1,idx2 = np.maximum(0,lags),np.minimum(n,n+lags)
+    sb = pb[...,idx2]-pb[...,idx1]
+    sa = pa[...,idx2-lags]-pa[...,idx1-lags]
+    return (sb+sa-2.*cross)/(idx2-idx1)
+
+# Goodness of a model; A01,A02,CP012 may have a leading axis of models,
+# in which case the goodness of each is returned
 def get_goodness(A01,A02,CP012):
     beta = 0.00001    #   this is a pretty vital parameter
     ascat = np.median(abs(np.gradient(np.ravel(a02))))
     cscat = np.median(abs(np.gradient(np.ravel(cp012))))
+    sq = ndiff(a01*np.nanmean(A01,axis=-1)[...,None]/np.nanmean(a01),A01)/ascat**2 + \
+         ndiff(a02*np.nanmean(A02,axis=-1)[...,None]/np.nanmean(a02),A02)/ascat**2 + \
+         ndiff(cp012,CP012)/cscat**2
+    difmin = 0.5*len(a01)-np.argmin(sq,axis=-1)
+    return np.min(sq,axis=-1) + beta*difmin**2
+
+# Gradient of ndiff(a,b) at lag k (one of range(-n/2,n/2) as in ndiff)
+# with respect to a and to b
+def ndiff_grad (a,b,k):
+    n = len(a)
+    i1,i2 = max(0,k),min(n,n+k)
+    gb,ga = np.zeros(n),np.zeros(n)
+    gb[i1:i2] = 2.*(b[i1:i2]-a[i1-k:i2-k])/(i2-i1)
+    ga[i1-k:i2-k] = -gb[i1:i2]
+    return ga,gb
+
+# get_goodness of a single model, with its gradient with respect to A01,
+# A02 and CP012, taken at the lag giving the minimum
+def get_goodness_grad(A01,A02,CP012):
+    beta = 0.00001    #   as get_goodness
+    ascat = np.median(abs(np.gradient(np.ravel(a02))))
+    cscat = np.median(abs(np.gradient(np.ravel(cp012))))
+    n = len(a01)
     sq = ndiff(a01*np.nanmean(A01)/np.nanmean(a01),A01)/ascat**2 + \
          ndiff(a02*np.nanmean(A02)/np.nanmean(a02),A02)/ascat**2 + \
          ndiff(cp012,CP012)/cscat**2
-    difmin = 0.5*len(a01)-np.argwhere(sq==sq.min())[0][0]
-    return sq.min() + beta*difmin**2
+    imin = np.argmin(sq)
+    goodness = sq[imin] + beta*(0.5*n-imin)**2
+    grad = []
+    for d,A,scat,scaled in ((a01,A01,ascat,True),(a02,A02,ascat,True),\
+                            (cp012,CP012,cscat,False)):
+        d = np.asarray(d,dtype=float)
+        if scaled:   # the data are scaled by the mean of the model
+            ga,gb = ndiff_grad(d*np.nanmean(A)/np.nanmean(d),A,imin-(n+1)//2)
+            gb += np.dot(ga,d)/np.nanmean(d)/np.isfinite(A).sum()
+        else:
+            ga,gb = ndiff_grad(d,A,imin-(n+1)//2)
+        grad.append(gb/scat**2)
+    return goodness,grad[0],grad[1],grad[2]
+
+# Model amplitudes A (with derivatives dA) scaled to the median of the
+# data a, as mod_func does if ampfiddle
+def amp_fiddle_grad (a,A,dA):
+    n = len(A)
+    order = np.argsort(A)
+    w = np.zeros(n)     # d median(A) / dA
+    w[order[(n-1)//2]] += 0.5
+    w[order[n//2]] += 0.5
+    med = np.median(A)
+    c = np.median(a)/med
+    return A*c,c*(dA-np.outer(np.dot(dA,w),A)/med)
+
+# As mod_func, returning also the gradient of the goodness with respect to
+# the parameters being optimised (analytic, at the lag of the minimum)
+def mod_func_grad (x0, *x):
+    model,opt,itel,aplot,gcou,iy,ix = x
+    model,opt = np.ravel(np.copy(model)),np.ravel(opt)
+    model[opt] = x0
+    model = model.reshape(len(model)/6,6)
+    A01,A02,CP012,dA01,dA02,dCP012 = model_extract_grad (model,itel)
+    if ampfiddle:
+        A01,dA01 = amp_fiddle_grad (a01,A01,dA01)
+        A02,dA02 = amp_fiddle_grad (a02,A02,dA02)
+    goodness,g01,g02,gcp = get_goodness_grad(A01,A02,CP012)
+    grad = np.dot(dA01,g01)+np.dot(dA02,g02)+np.dot(dCP012,gcp)
+    if plottype:
+        plotimg (A01,A02,CP012,model,goodness,itel,aplot,gcou)
+        if plottype in [1,2]:
+            plt.draw()
+            plt.pause(0.001)
+            plt.clf()
+    return goodness,grad[opt]
 
 def mod_func (x0, *x):
     model,opt,itel,aplot,gcou,iy,ix = x
@@ -492,26 +560,26 @@ def getmodel(coord,beam,firstnpy):
     gsiz = int(gridsize/(bsub*beam))   # original grid very big
     ginc = bsub*beam                   # arcsec/pix grid size
     grid = np.ones((gsiz,gsiz))*np.nan # original grid full of NaN
-    first = np.load(firstnpy)
     pflux,pcoord = [],[]
-    a = correlate (np.array([coord]),0,1,first,0,1,0.5/60)
+    a,sep = first_near(firstnpy,coord[0],coord[1],0.5/60)
     cosdec = np.cos(np.deg2rad(coord[1]))
     print 'Found: %d FIRST sources'%len(a)
-    for i in range(len(a)):
-        fi = first[int(a[i,1])]
+    for fi in a:
         scoord = astropy.coordinates.SkyCoord(fi[0],fi[1],unit='degree')
         scoord = scoord.to_string(style='hmsdms')
         scoord = scoord.replace('d',':').replace('m',':')
         scoord = scoord.replace('h',':').replace('s','')
         print '%s flux=%.1f shape=(%.1fx%.1f PA%.1f)'%(scoord,fi[2],fi[4],fi[5],fi[6])
-        pix = 0.5*gsiz+3600.*(fi[:2]-coord)*np.array([cosdec/ginc,1./ginc])
         try:
             pcoord.append(fi[:2]-coord)*np.array([cosdec/ginc,1./ginc])
         except:
             pcoord = (fi[:2]-coord)*np.array([cosdec/ginc,1./ginc])
         pflux.append(fi[2])
-        new = mkgauss([gsiz,gsiz],pix,fi[2],fi[4]/ginc,fi[5]/fi[4],fi[6])
-        np.putmask(grid,new>0.004*new.max(),i)  # decrease 0.01 if missing cpts
+    if len(a):   # label where each source might be; decrease 0.004 if missing cpts
+        fi = a
+        pix = 0.5*gsiz+3600.*(fi[:,:2]-coord)*np.array([cosdec/ginc,1./ginc])
+        mkgauss_many([gsiz,gsiz],pix,fi[:,2],fi[:,4]/ginc,fi[:,5]/fi[:,4],fi[:,6],\
+                     labels=grid,labthresh=0.004)
     # grid now consists of original very big grid, with numbers instead of NaN where
     # the secondary might be
     if pflux:    # shrink the grid around the Gaussian near FIRST sources
@@ -520,52 +588,113 @@ def getmodel(coord,beam,firstnpy):
             grid = grid[1:-1,1:-1]
     return grid,ginc,grid.shape[0],pflux,pcoord
 
-def parallel_function(f):
-    def easy_parallize(f, sequence):
-        from multiprocessing import Pool
-        ncores = max(1,int(os.popen('nproc').read())-1)  # use all cores - 1
-        print 'Using',ncores,'cores'
-        pool = Pool(processes=ncores) # depends on available cores
-        result = pool.map(f, sequence) # for i in sequence: result[i] = f(i)
-        cleaned = [x for x in result if not x is None] # getting results
-        cleaned = np.asarray(cleaned)
-        pool.close() # not optimal! but easy
-        pool.join()
-        return cleaned
-    from functools import partial
-    return partial(easy_parallize, f)
-
+# Worker of the per-point (plotting) grid search. Only the position and
+# plot number are sent; the model, data and plot grid are in the globals
+# (gridtask and the memory-mapped data) the worker was forked with.
 def grid_search_thread (k):
-    a =  mod_func(k[0],k[1],k[2],k[3],k[4],k[5],k[6],k[7])
+    x,y,iy,ix,gcou = k
+    model,cpt,opt,itel,aplot = gridtask
+    model = np.copy(model)
+    model[cpt][0],model[cpt][1] = x,y
+    a =  mod_func([],model,opt,itel,aplot,gcou,iy,ix)
     f=open('grid_search_thread.log','a')
-    f.write('%d %d %f\n'%(k[-2],k[-1],a))
+    f.write('%d %d %f\n'%(iy,ix,a))
     f.close()
     return a
 
-def grid_search (model,cpt,gridcpt,itel,aplot,gcou,grid,gsiz,ginc,isparallel=ISPARALLEL):
-    opt = np.zeros_like(model,dtype='bool')
-    args = []
-    import copy
-    for ix in range(gsiz):
-        x = ginc*(ix-gsiz/2.0)   # x,y in arcsec; a in ginc-size pixels
-        for iy in range(gsiz):
-            if grid[iy,ix] == gridcpt:
-                y = ginc*(iy-gsiz/2.0)
-                model[cpt][0],model[cpt][1] = x,y
-                if isparallel:
-                    arg = ([],model,opt,itel,aplot,gcou,iy,ix)
-                    args.append(copy.deepcopy(arg))   # otherwise overwrites all elements
-                    gcou += 1
-                else:
-                    aplot[iy][ix] = mod_func ([],model,opt,itel,aplot,gcou,iy,ix)
-                    gcou += 1
-    if isparallel:
-        print 'Starting grid search with',len(args),'points'
-        os.system('rm grid_search_thread.log')
-        grid_search_thread.parallel = parallel_function(grid_search_thread)
-        parallel_result = grid_search_thread.parallel (args)
-        for i in range(len(parallel_result)):
-            aplot[args[i][-2],args[i][-1]] = parallel_result[i]
+# Worker of the batched grid search: goodness of positions i0 to i1 of
+# gridtask, which the worker was forked with
+def grid_block_thread (k):
+    i0,i1 = k
+    model,cpt,itel,pos = gridtask
+    return grid_goodness(model,cpt,pos[i0:i1],itel)
+
+# Goodness (as mod_func) of the model with component cpt at each of the
+# positions pos, evaluated together
+def grid_goodness (model,cpt,pos,itel):
+    A01,A02,CP012 = model_extract_grid (model,cpt,pos,itel)
+    if ampfiddle:
+        A01 *= np.median(a01)/np.median(A01,axis=-1)[:,None]
+        A02 *= np.median(a02)/np.median(A02,axis=-1)[:,None]
+    return get_goodness(A01,A02,CP012)
+
+# Fill aplot at the cells iy,ix, scoring blocks of positions as arrays;
+# if isparallel, the blocks are shared out over worker processes, each
+# task being just the index range of its block
+def grid_cells (model,cpt,itel,aplot,iy,ix,gsiz,ginc,isparallel=False):
+    global gridtask
+    pos = ginc*(np.transpose([ix,iy])-gsiz/2.0)   # x,y in arcsec
+    nblk = max(1,GRIDBLOCK//len(uvw01))
+    ncpu = nproc() if isparallel else 1
+    if ncpu > 1 and len(pos) > nblk:
+        nblk = max(1,min(nblk,int(np.ceil(len(pos)/float(ncpu)))))
+        gridtask = (model,cpt,itel,pos)
+        blocks = [(i,min(i+nblk,len(pos))) for i in range(0,len(pos),nblk)]
+        for i,goodness in schedule(grid_block_thread,blocks,cores=ncpu):
+            i0,i1 = blocks[i]
+            aplot[iy[i0:i1],ix[i0:i1]] = goodness
+        return
+    for i in range(0,len(pos),nblk):
+        aplot[iy[i:i+nblk],ix[i:i+nblk]] = \
+            grid_goodness(model,cpt,pos[i:i+nblk],itel)
+
+# Coarse-to-fine search: score the allowed cells on a lattice of step
+# coarse, keep the best GRIDKEEP of the cells scored so far, score the
+# cells of the lattice of half the step within one old step of those, and
+# so on down to step 1. Cells never scored are left NaN. coarse=1 scores
+# every cell.
+def grid_refine (model,cpt,gridcpt,itel,aplot,grid,gsiz,ginc,coarse=GRIDCOARSE,\
+                 isparallel=False):
+    ok = grid == gridcpt
+    idx = np.arange(gsiz)
+    done = np.zeros_like(ok)
+    step,near = max(1,int(coarse)),np.ones_like(ok)
+    while True:
+        todo = ok & near & ~done & (idx[:,None]%step==0) & (idx[None,:]%step==0)
+        iy,ix = np.nonzero(todo)
+        grid_cells (model,cpt,itel,aplot,iy,ix,gsiz,ginc,isparallel)
+        done |= todo
+        if step == 1:
+            break
+        if done.any():
+            nkeep = min(done.sum(),max(GRIDKEEPMIN,int(GRIDKEEP*done.sum())))
+            best = done & (aplot <= np.sort(aplot[done])[nkeep-1])
+            near = ndimage.binary_dilation(best,np.ones((2*step+1,2*step+1)))
+        step = step//2
+    print 'Grid search scored %d of %d points'%(done.sum(),ok.sum())
+    return aplot
+
+def grid_search (model,cpt,gridcpt,itel,aplot,gcou,grid,gsiz,ginc,isparallel=ISPARALLEL,\
+                 coarse=GRIDCOARSE):
+    global gridtask
+    if not plottype:
+        # no plot per grid point: score blocks of positions as arrays,
+        # coarse to fine
+        aplot = grid_refine (model,cpt,gridcpt,itel,aplot,grid,gsiz,ginc,coarse,\
+                             isparallel)
+    else:
+        opt = np.zeros_like(model,dtype='bool')
+        args = []
+        gridtask = (np.copy(model),cpt,opt,itel,np.copy(aplot))
+        for ix in range(gsiz):
+            x = ginc*(ix-gsiz/2.0)   # x,y in arcsec; a in ginc-size pixels
+            for iy in range(gsiz):
+                if grid[iy,ix] == gridcpt:
+                    y = ginc*(iy-gsiz/2.0)
+                    model[cpt][0],model[cpt][1] = x,y
+                    if isparallel:
+                        args.append((x,y,iy,ix,gcou))
+                        gcou += 1
+                    else:
+                        aplot[iy][ix] = mod_func ([],model,opt,itel,aplot,gcou,iy,ix)
+                        gcou += 1
+        if isparallel:
+            print 'Starting grid search with',len(args),'points'
+            os.system('rm grid_search_thread.log')
+            grid_search_thread.parallel = parallel_function(grid_search_thread)
+            parallel_result = grid_search_thread.parallel (args)
+            for i in range(len(parallel_result)):
+                aplot[args[i][2],args[i][3]] = parallel_result[i]
     np.putmask(aplot,np.isnan(aplot),np.nanmax(aplot))
     model[cpt,:2] = ginc*(np.asarray(ndimage.measurements.minimum_position \
             (aplot)[::-1])-0.5*np.asarray(grid.shape))
@@ -577,27 +706,58 @@ def recentroid (model,startcpt,endcpt,ginc,gsiz):
     model[startcpt:endcpt+1,:2] -= centroid
     return model
 
-def adjust_all (model,itel,aplot,gcou):
-    opt = np.ones_like(model,dtype='bool')
+# Bounds of each model parameter for the gradient fit: positions and
+# widths within the search grid (or as far out as they start), positive
+# flux, free PA. The axis ratio may go above 1 (up to 10), since at 1 the
+# PA has no gradient and a ratio above 1 is how a wrong PA gets turned.
+def fit_bounds (model):
+    bounds = []
+    for m in model:
+        lim = [max(glim,abs(m[MX])),max(glim,abs(m[MY])),max(glim,m[MW])]
+        bounds += [(-lim[0],lim[0]),(-lim[1],lim[1]),(0.0,None),\
+                   (0.01,lim[2]),(0.01,max(10.0,m[MR])),(None,None)]
+    return bounds
+
+# mod_func_grad of the parameters divided by scale (so that all are of
+# order 1 for the optimiser)
+def mod_func_scaled (y, scale, *x):
+    goodness,grad = mod_func_grad (y*scale, *x)
+    return goodness,grad*scale
+
+# Fit the parameters of model flagged in opt, by L-BFGS-B on the analytic
+# gradient (FITMODE 'gradient') or the downhill simplex (FITMODE 'simplex').
+# For L-BFGS-B fluxes are in units of the brightest component and PAs of
+# 90 degrees.
+def fit_model (model,opt,itel,aplot,maxiter):
     x0 = np.ravel(model)[np.ravel(opt)]
     args = (model,opt,itel,aplot,-1,0,0)
-    xopt = optimize.fmin(mod_func, x0, args=args, maxiter=100)
+    if FITMODE == 'simplex':
+        xopt = optimize.fmin(mod_func, x0, args=args, maxiter=maxiter)
+    else:
+        scale = np.ones_like(model)
+        scale[:,MF],scale[:,MP] = max(model[:,MF].max(),1.e-6),90.0
+        scale = np.ravel(scale)[np.ravel(opt)]
+        bounds = [b for b,o in zip(fit_bounds(model),np.ravel(opt)) if o]
+        bounds = [tuple([None if l is None else l/sc for l in b]) \
+                  for b,sc in zip(bounds,scale)]
+        yopt,fopt,info = optimize.fmin_l_bfgs_b(mod_func_scaled, x0/scale,\
+                         args=(scale,)+args, bounds=bounds, maxiter=maxiter)
+        xopt = yopt*scale
+        print 'L-BFGS-B: goodness %f after %d evaluations'%(fopt,info['funcalls'])
     model,opt = np.ravel(model),np.ravel(opt)
     model[opt] = xopt
     model = model.reshape(len(model)/6,6)
     return model
 
+def adjust_all (model,itel,aplot,gcou):
+    opt = np.ones_like(model,dtype='bool')
+    return fit_model (model,opt,itel,aplot,100)
+
 def refine_points (model,cpts,itel,aplot,gcou):
     opt = np.zeros_like(model,dtype='bool')
     for i in cpts:
         opt[i,2:] = True
-    x0 = np.ravel(model)[np.ravel(opt)]
-    args = (model,opt,itel,aplot,-1,0,0)
-    xopt = optimize.fmin(mod_func, x0, args=args, maxiter=20)
-    model,opt = np.ravel(model),np.ravel(opt)
-    model[opt] = xopt
-    model = model.reshape(len(model)/6,6)
-    return model
+    return fit_model (model,opt,itel,aplot,20)
 
 def write_skymodel (ra,dec,model,outname):
 
@@ -626,47 +786,51 @@ def write_skymodel (ra,dec,model,outname):
     if outname!='':
         f.close()
 
-def model_engine(vis,TRNAME,firstnpy,BSUB=0.3,GRIDSIZE=12.0,PLOTTYPE=20,AMPFIDDLE=True,outname='model_engine.sky'):
-    global bsub,gridsize,plottype,ampfiddle,glim,trname
+def model_engine(vis,TRNAME,firstnpy,BSUB=0.3,GRIDSIZE=12.0,PLOTTYPE=20,AMPFIDDLE=True,outname='model_engine.sky',SINGLE=False):
+    global bsub,gridsize,plottype,ampfiddle,glim,trname,UVDTYPE
     bsub,gridsize,plottype,ampfiddle,trname,gcou = BSUB,GRIDSIZE,PLOTTYPE,AMPFIDDLE,TRNAME,0
+    UVDTYPE = 'float32' if SINGLE else 'float64'
     os.system('rm model_engine*.png')
     itel,wv,ra,dec = data_extract (vis)
-    s_amp = np.sort(np.ravel(a01)); ls = len(s_amp)
-    flux1,flux2 = np.median(s_amp), 0.5*(s_amp[int(0.99*ls)]-s_amp[int(0.01*ls)])
-    flux = np.median(a01)
-    beam = RAD2ARC/np.nanmax(abs(uvw01)); print 'Beam:',beam,'arcsec'
-    grid,ginc,gsiz,pflux,pcoord = getmodel (np.array([ra,dec]),beam,firstnpy)
-    if not len(pflux):   # no FIRST source, search the whole grid
-        grid = np.zeros_like (grid)
-    aplot = np.ones_like(grid)*np.nan
-    glim = 0.5*ginc*gsiz
-    if plottype in [1,2]:
-        plt.ion()
-        fig = plt.figure()
-    if len(pflux) < 2:    # zero, or one FIRST source
-        model = np.array([[0.0,0.0,flux1,0.5,1.0,0.0],[-1.0,-2.0,flux2,0.5,1.0,0.0]])
-        model,aplot = grid_search (model,1,0,itel,aplot,gcou,grid,gsiz,ginc)
+    try:
+        s_amp = np.sort(np.ravel(a01)); ls = len(s_amp)
+        flux1,flux2 = np.median(s_amp), 0.5*(s_amp[int(0.99*ls)]-s_amp[int(0.01*ls)])
+        flux = np.median(a01)
+        beam = RAD2ARC/np.nanmax(abs(uvw01)); print 'Beam:',beam,'arcsec'
+        grid,ginc,gsiz,pflux,pcoord = getmodel (np.array([ra,dec]),beam,firstnpy)
+        if not len(pflux):   # no FIRST source, search the whole grid
+            grid = np.zeros_like (grid)
+        aplot = np.ones_like(grid)*np.nan
+        glim = 0.5*ginc*gsiz
+        if plottype in [1,2]:
+            plt.ion()
+            fig = plt.figure()
+        if len(pflux) < 2:    # zero, or one FIRST source
+            model = np.array([[0.0,0.0,flux1,0.5,1.0,0.0],[-1.0,-2.0,flux2,0.5,1.0,0.0]])
+            model,aplot = grid_search (model,1,0,itel,aplot,gcou,grid,gsiz,ginc)
 # fix one cpt, grid-search posn of 2nd.
-        print 'Model after grid search:'
-        write_skymodel (ra,dec,model,'')
-        model[0,MW] = model[1,MW] = 1.0
-        model = refine_points (model,[0,1],itel,aplot,gcou)
+            print 'Model after grid search:'
+            write_skymodel (ra,dec,model,'')
+            model[0,MW] = model[1,MW] = 1.0
+            model = refine_points (model,[0,1],itel,aplot,gcou)
 # fit for size/orientation only
-        print 'Model after refining points:'
+            print 'Model after refining points:'
+            write_skymodel (ra,dec,model,'')
+            model = recentroid (model,0,1,ginc,gsiz)  # put centroid in centre of image
+            print 'Model after recentroiding:'
+        else:   # >1 FIRST source - not tested yet
+            model = np.zeros((len(pflux),6))
+            for i in range(len(pflux)):
+                model[i,:2] = pcoord[i]
+                model[i,3] = pflux[i]*flux/pflux.sum()
+                model[i,4:] = [0.5,1.0,0.0]
+            model = adjust_all(model,itel,aplot,gcou)
+        if plottype in [10,20]:
+            movie()
         write_skymodel (ra,dec,model,'')
-        model = recentroid (model,0,1,ginc,gsiz)  # put centroid in centre of image
-        print 'Model after recentroiding:'
-    else:   # >1 FIRST source - not tested yet
-        model = np.zeros((len(pflux),6))
-        for i in range(len(pflux)):
-            model[i,:2] = pcoord[i]
-            model[i,3] = pflux[i]*flux/pflux.sum()
-            model[i,4:] = [0.5,1.0,0.0]
-        model = adjust_all(model,itel,aplot,gcou)
-    if plottype in [10,20]:
-        movie()
-    write_skymodel (ra,dec,model,'')
-    write_skymodel (ra,dec,model,outname)
+        write_skymodel (ra,dec,model,outname)
+    finally:
+        shutil.rmtree (datadir,ignore_errors=True)
 
 ################## skynet ##############################
 
@@ -689,12 +853,13 @@ def skynet_NDPPP (vis,model,solint=1.0):
     f.close()
     os.system('NDPPP NDPPP.parset')
 
-def main (vis, self_cal_script, firstnpy, delayCalFile='', mode=3, closure_tels=['ST001','DE601','DE605'],cthr=1.6, model_only=0 ):
+def main (vis, self_cal_script, firstnpy, delayCalFile='', mode=3, closure_tels=['ST001','DE601','DE605'],cthr=1.6, model_only=0, single=0 ):
 
     ## make sure the parameters are the correct format
     mode = int( mode )
     cthr = float( cthr )
     model_only = int( model_only )
+    single = int( single )
 
     ## get flux from primary_delay_calibrator.csv
     with open( delayCalFile, 'r' ) as f:
@@ -706,8 +871,7 @@ def main (vis, self_cal_script, firstnpy, delayCalFile='', mode=3, closure_tels=
     if not len(closure_tels) == 3:
 	closure_tels = closure_tels.split(';')
     
-    ra,dec = taql_from (vis, 'FIELD', 'PHASE_DIR')
-    # convert to ??
+    ra,dec = np.rad2deg(ms_phase_centre (vis))
     closure_scatter = closure(vis, closure_tels, plotfile='')
     print closure_scatter
     if closure_scatter > cthr:
@@ -733,7 +897,7 @@ def main (vis, self_cal_script, firstnpy, delayCalFile='', mode=3, closure_tels=
 	    os.system ( ss )
     if mode == 3:   # make an engine model and selfcal against this
 	print 'mode 3: model_engine model'
-        model_engine (vis,closure_tels,firstnpy,PLOTTYPE=0,outname=vis+'_mod')
+        model_engine (vis,closure_tels,firstnpy,PLOTTYPE=0,outname=vis+'_mod',SINGLE=single)
 	if model_only == 0:
             skynet_NDPPP (vis,vis+'_mod',solint=5)
             os.system('python '+self_cal_script+' -d CORRECTED_DATA '+vis+' -p')
@@ -754,8 +918,9 @@ if __name__ == "__main__":
     parser.add_argument('--cthr',type=float,help='Threshold for closure phase scatter.', default=1.6)
     parser.add_argument('--model_only',type=int,help='set to 1 to get model only',default=0)
     parser.add_argument('--delay_cal_file',type=str,help='delay calibrator information')
+    parser.add_argument('--single',type=int,help='set to 1 to predict model visibilities in single precision (faster)',default=0)
 
     args = parser.parse_args()
 
-    main( args.vis, args.self_cal_script, args.firstnpy, mode=args.mode, closure_tels=args.closure_tels, cthr=args.cthr, model_only=args.model_only, delayCalFile=args.delay_cal_file )
+    main( args.vis, args.self_cal_script, args.firstnpy, mode=args.mode, closure_tels=args.closure_tels, cthr=args.cthr, model_only=args.model_only, delayCalFile=args.delay_cal_file, single=args.single )
 
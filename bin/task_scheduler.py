@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import os,traceback,multiprocessing,numpy as np
+from functools import partial
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Resource-aware task scheduler shared by the pipeline scripts.
+#
+# Tasks are run in a pool of worker processes, but a task is only started
+# while the cores, memory and I/O slots it declares fit in what is left of
+# the budgets. Tasks are started in input order; one that does not fit
+# waits (with those after it) until enough running tasks have finished. A
+# task bigger than a whole budget is run on its own. Results are yielded
+# as the tasks finish.
+#
+# Budgets: cores, memory (bytes) and I/O slots. If not given they are taken
+# from the environment (TASK_CORES, TASK_MEMORY, TASK_IOSLOTS), otherwise
+# nproc-1 cores, 80% of the available memory and as many I/O slots as cores.
+# A task's need is (cores, memory, ioslots), either one tuple for all tasks
+# or a function of the task argument returning it.
+
+NEED = (1,0,0)       # default need of a task: one core, no memory, no I/O
+POLL = 1.0           # seconds between checks for finished tasks
+
+def nproc(reserve=1):
+    return max(1,int(os.popen('nproc').read())-reserve)
+
+def available_memory():
+    try:
+        for l in open('/proc/meminfo'):
+            if l.startswith('MemAvailable:'):
+                return int(l.split()[1])*1024
+    except (IOError,ValueError):
+        pass
+    return np.inf
+
+def budgets(cores=None,mem=None,io=None,reserve=1):
+    cores = cores or int(os.environ.get('TASK_CORES',0)) or nproc(reserve)
+    mem = mem or float(os.environ.get('TASK_MEMORY',0)) or 0.8*available_memory()
+    io = io or int(os.environ.get('TASK_IOSLOTS',0)) or cores
+    return np.array([cores,mem,io],dtype='float')
+
+# Run one task in a worker; exceptions are sent back to the parent, since
+# a failed task would otherwise never report back
+
+def run_task(f,i,arg):
+    try:
+        return i,True,f(arg)
+    except Exception:
+        return i,False,traceback.format_exc()
+
+# Generator of (index, result) for f applied to every element of sequence,
+# in order of completion. If stop(result) is True for a finished task, no
+# further tasks are started; those already running are still collected.
+# The same holds when a task fails, and the RuntimeError carrying its
+# traceback is raised once the running tasks have finished.
+
+def schedule(f,sequence,cores=None,mem=None,io=None,need=NEED,reserve=1,\
+             stop=None):
+    sequence = list(sequence)
+    if not len(sequence):
+        return
+    limit = budgets(cores,mem,io,reserve=reserve)
+    needs = np.array([need(x) if callable(need) else need for x in sequence],\
+                     dtype='float')
+    print 'Scheduling',len(sequence),'tasks on',int(limit[0]),'cores,',\
+          '%.1f GB,'%(limit[1]/1024.**3),int(limit[2]),'I/O slots'
+    pool = multiprocessing.Pool(processes=int(min(limit[0],len(sequence))))
+    done = queue.Queue()
+    used,running,nextidx,nleft = np.zeros(3),{},0,len(sequence)
+    stopped,failed = False,None
+    try:
+        while nleft and not (stopped and not running):
+            while nextidx < len(sequence) and not stopped and (not running or \
+                  np.all(used+needs[nextidx] <= limit)):
+                pool.apply_async(run_task,(f,nextidx,sequence[nextidx]),\
+                                 callback=done.put)
+                running[nextidx] = needs[nextidx]
+                used += needs[nextidx]
+                nextidx += 1
+            try:
+                i,ok,result = done.get(True,POLL)
+            except queue.Empty:
+                continue
+            used -= running.pop(i)
+            nleft -= 1
+            if not ok:
+                if failed is None:
+                    print 'Task',i,'failed, waiting for the',len(running),\
+                          'running tasks before stopping'
+                    failed = 'task %d failed:\n%s'%(i,result)
+                stopped = True
+                continue
+            if stop is not None and not stopped and stop(result):
+                print 'Task',i,'met the stop condition, starting no more tasks'
+                stopped = True
+            yield i,result
+        pool.close()
+        pool.join()
+        if failed is not None:
+            raise RuntimeError(failed)
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Drop-in for the old parallel_function (Scott Sievert): returns g so that
+# g(sequence) gives the non-None results of f in input order, as an array
+
+def parallel_function(f,ncpu=None,mem=None,io=None,need=NEED,reserve=1):
+    def easy_parallize(f, sequence):
+        result = [None]*len(sequence)
+        for i,r in schedule(f,sequence,cores=ncpu,mem=mem,io=io,need=need,\
+                            reserve=reserve):
+            result[i] = r
+        cleaned = [x for x in result if not x is None] # getting results
+        return np.asarray(cleaned)
+    return partial(easy_parallize, f)
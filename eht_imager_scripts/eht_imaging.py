@@ -2,6 +2,7 @@
 import numpy as np
 import ehtim as eh
 import os
+import sys
 import math 
 import pyrap.tables as pt
 import pyfits 
@@ -15,6 +16,8 @@ from ehtim.observing.obs_helpers import *
 from ehtim.imaging.imager_utils import *
 from astropy.coordinates import SkyCoord
 from astropy.io import ascii
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','bin'))
+from first_index import first_near
 
 # Plot a fitsfile giving a png out. Optionally specify the white/black levels. Return the 0.25% and
 # 99.75% percentile; these are the aplpy defaults for plotting, so this allows a subsequent call to
@@ -251,11 +254,9 @@ def main(vis, closure_tels='DE601;DE602;DE603;DE604;DE605;FR606;SE607;UK608;DE60
         print( 'Using FIRST.' )
         if not os.path.isfile('./first_2008.simple.npy'):
             os.system('wget http://www.jb.man.ac.uk/~njj/first_2008.simple.npy')
-        first = np.load('first_2008.simple.npy')
         # firstdata = first_download(ra,dec,imsize=maxarcmin)
     # lkm - this is the else statement, it may not work 
-        spatial_separations = sepn(np.deg2rad(ra),np.deg2rad(dec),np.deg2rad(first[:,0]),np.deg2rad(first[:,1]))
-        corrfirst = np.where( spatial_separations <= as2rad(maxarcmin*60.0) )[0]
+        corrfirst,spatial_separations = first_near('first_2008.simple.npy',ra,dec,maxarcmin/60.0)
         if not len(corrfirst):           # no FIRST, fall back to default
             print 'No FIRST sources, using default'
             prior_fwhm = as2rad(prior_fwhm_arcsec)
@@ -265,8 +266,7 @@ def main(vis, closure_tels='DE601;DE602;DE603;DE604;DE605;FR606;SE607;UK608;DE60
             print 'Prior image: circular Gaussian %f arcsec' % prior_fwhm_arcsec
         else:
             gaussparams, gflux = np.array([]),np.array([])
-            for i in corrfirst:
-                this = first[int(i)]
+            for this in corrfirst:
                 gflux = np.append(gflux,this[3])
                 decdiff = np.deg2rad(this[1]-dec)
                 radiff = np.deg2rad(this[0]-ra)*np.cos(np.deg2rad(dec))
@@ -3,7 +3,10 @@ from lofarpipe.support.data_map import DataMap
 from lofarpipe.support.data_map import DataProduct
 import numpy as np
 import glob
+import sys
 from astropy.io import ascii
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','bin'))
+from results_store import best_result
 
 
 # Leah Morabito, May 2017
@@ -19,7 +22,8 @@ def plugin_main(args, **kwargs):
     closurePhaseMap: str
         Name of output mapfile
     closurePhase_file: str
-	Name of file with closure phase scatter
+	Name of file with closure phase scatter (the results database of the
+	same name with extension .db is used if it exists)
 
     Returns
     -------
@@ -30,28 +34,36 @@ def plugin_main(args, **kwargs):
     delaycal_list	= kwargs['delaycals']
     clphase_file 	= kwargs['clphase_file']
 
-    # read the file
-    with open( clphase_file, 'r' ) as f:
-	lines = f.readlines()
-    f.close()
-
-    ## get lists of directions and scatter
-    direction = []
-    scatter = []
-    for l in lines:
-        direction.append(l.split()[4])
-        scatter.append(np.float(l.split()[6]))
-
-    ## convert to numpy arrays
-    direction = np.asarray( direction )
-    scatter = np.asarray( scatter )
-
-    ## find the minimum scatter
-    if len(scatter) > 1:
-        min_scatter_index = np.where( scatter == np.min( scatter ) )[0]
-        best_calibrator = direction[min_scatter_index[0]]
-    else:
-        best_calibrator = direction[0][0]
+    ## best direction from the results database written by the workers
+    ## (indexed on scatter), if there is one; otherwise parse the text file
+    best_calibrator = None
+    best = best_result( os.path.splitext( clphase_file )[0] + '.db' )
+    if best is not None:
+        best_calibrator = str( best['direction'] )
+
+    if best_calibrator is None:
+        # read the file
+        with open( clphase_file, 'r' ) as f:
+            lines = f.readlines()
+        f.close()
+
+        ## get lists of directions and scatter
+        direction = []
+        scatter = []
+        for l in lines:
+            direction.append(l.split()[4])
+            scatter.append(np.float(l.split()[6]))
+
+        ## convert to numpy arrays
+        direction = np.asarray( direction )
+        scatter = np.asarray( scatter )
+
+        ## find the minimum scatter
+        if len(scatter) > 1:
+            min_scatter_index = np.where( scatter == np.min( scatter ) )[0]
+            best_calibrator = direction[min_scatter_index[0]]
+        else:
+            best_calibrator = direction[0][0]
 
     a = ascii.read(delaycal_list)
 
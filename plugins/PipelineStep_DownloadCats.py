@@ -148,6 +148,7 @@ def my_lbcs_catalogue( ms_input, Radius=1.5 ):
         counts.append(b)
         if b >=2:
             P_count = P_count + 1    #### To determine how many sources to take 
+    tb['P_count'] = counts
     print 'Good sources - ' + str(P_count)
     if P_count == 0:
         logging.critical('There are no good LBCS sources within the given radius. Check your source is within the LBCS footprint and increase the search radius. Exiting...')
@@ -166,7 +167,7 @@ def my_lbcs_catalogue( ms_input, Radius=1.5 ):
     tb_sorted.remove_rows(result)
 
     ## keep only some columns
-    tb_out = tb_sorted['raj2000','decj2000','ObsID']
+    tb_out = tb_sorted['raj2000','decj2000','ObsID','P_count']
 
     return tb_out
 
@@ -185,12 +186,14 @@ def find_close_objs(lo, lb, tolerance=5.):
     rms=np.array(lo['Isl_rms'])
     resolved=np.array(lo['Resolved'])
     lbcsid=np.array(lb['ObsID'])
+    lbcsp=np.array(lb['P_count'])
 
     ## astropy.tables.Table is fast at adding columns, less fast at adding rows -- since it has to make a copy each time
     Source_id = []
     LBCS_ID = []
     LBCS_RA = []
     LBCS_DEC = []
+    LBCS_P = []
     LOTSS_RA = []
     LOTSS_DEC = []
     Delta_Position = []
@@ -217,6 +220,7 @@ def find_close_objs(lo, lb, tolerance=5.):
 		LBCS_ID.append(lbcsid[x])
 		LBCS_RA.append(lbcsRA[x])
 		LBCS_DEC.append(lbcsDEC[x])
+		LBCS_P.append(lbcsp[x])
 	        LOTSS_RA.append(lotssRA[c_idx][0])
 	        LOTSS_DEC.append(lotssDEC[c_idx][0])
 	        Delta_Position.append(np.min(delta_position))
@@ -233,6 +237,7 @@ def find_close_objs(lo, lb, tolerance=5.):
 	result['LBCS_ID'] = LBCS_ID
         result['LBCS_RA'] = LBCS_RA
         result['LBCS_DEC'] = LBCS_DEC
+        result['LBCS_P'] = LBCS_P
         result['LOTSS_RA'] = LOTSS_RA
         result['LOTSS_DEC'] = LOTSS_DEC
         result['Delta_Position'] = Delta_Position
@@ -261,6 +266,7 @@ def find_close_objs(lo, lb, tolerance=5.):
             result['LBCS_ID'] = [lbcsid]
             result['LBCS_RA'] = [lbcsRA]
             result['LBCS_DEC'] = [lbcsDEC]
+            result['LBCS_P'] = [lbcsp]
             result['LOTSS_RA'] = [lotssRA[c_idx][0]]
             result['LOTSS_DEC'] = [lotssDEC[c_idx][0]]
             result['Delta_Position'] = [np.min(delta_position)]
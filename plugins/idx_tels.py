@@ -6,35 +6,10 @@
 # the AIPS telescope number (starts at 1) in this case.
 # Output is a list of indices of telescopes. Note that you need to use the
 # lower one first if reading data out of a MS.
-import os,numpy as np
-def get_idx_tels (data, tel):
-    os.system('taql \'select NAME from %s/ANTENNA\' >closure_which'%data)
-    f = open('closure_which')
-    for line in f:
-        if 'select' in line or not len(line.rstrip('\n')):
-            continue
-        try:
-            a = int(line) # it's just a number, use STATION column instead
-            f.close()
-            os.system('taql \'select STATION from %s/ANTENNA\' >closure_which'%data)
-            break
-        except:
-            f.close()
-            break
-    idx_tels, iline = [-1]*len(tel), 0
-    f = open('closure_which')
-    for line in f:
-        if not 'select' in line:
-            for i in range(len(tel)):
-                if tel[i]==line[:len(tel[i])]:
-                    idx_tels[i] = iline
-            iline += 1
-    f.close()
-    if -1 in idx_tels:
-        os.system('cat closure_which')
-        print 'Did not find one or more of the telescopes'
-        print 'Telescopes present are those in list above'
-        return []
-    os.system('rm closure_which')
-    return idx_tels
+# The ANTENNA table is read in-process by bin/ms_meta.py.
+import os,sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','bin'))
+from ms_meta import ms_idx_tels
 
+def get_idx_tels (data, tel):
+    return ms_idx_tels (data, tel)
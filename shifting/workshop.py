@@ -1,4 +1,6 @@
 import numpy as np,sys,os,multiprocessing,glob
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','bin'))
+from task_scheduler import parallel_function
 #
 # ------- parameters for main script
 #
@@ -7,6 +9,7 @@ file_prefix = 'L401323_SB'
 file_suffix = '_uv.dppp.ndppp_prep_target'
 subbands = range(250,350)
 ncores = int(os.popen('nproc').read()) - 4
+ioslots = ncores    # shifts reading the subbands at the same time
 aipsno = 341
 indisk = 1
 refname = 'ST001'
@@ -120,21 +123,6 @@ def combine_subbands (in1array, nameout, phasecenter, fstep, tstep):
     fo.close()
     os.system('NDPPP NDPPP_%s.parset'%nameout)  # run with NDPPP
 
-def parallel_function(f):            # Scott Sievert parallelize function
-    def easy_parallize(f, sequence):
-        from multiprocessing import Pool
-        ncores = max(1,int(os.popen('nproc').read())-5)  # use all cores -5
-        print 'Using',ncores,'cores'
-        pool = Pool(processes=ncores) # depends on available cores
-        result = pool.map(f, sequence) # for i in sequence: result[i] = f(i)
-        cleaned = [x for x in result if not x is None] # getting results
-        cleaned = np.asarray(cleaned)
-        pool.close() # not optimal! but easy
-        pool.join()
-        return cleaned
-    from functools import partial
-    return partial(easy_parallize, f)
-
 def source_thread (i):
     rn_rh = i.split('h')[0]
     rn_rm = i.split('h')[1].split('m')[0]
@@ -161,7 +149,8 @@ def source_thread (i):
     print 'PROCESSING SOURCE %s - finished' % rn
 
 def source (coords):
-    source_thread.parallel = parallel_function(source_thread)
+    source_thread.parallel = parallel_function(source_thread,reserve=5,io=ioslots,\
+                                              need=(1,0,1))
     parallel_result = source_thread.parallel(coords)
     
 #  ----------------------- main script -------------------------
@@ -0,0 +1,38 @@
+import os,sys,numpy as np,pytest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','bin'))
+import crossmatch
+
+def brute(a,b,dist,isabs):
+    pairs = []
+    for i in range(len(a)):
+        if isabs:
+            d = np.hypot(a[i,0]-b[:,0],a[i,1]-b[:,1])
+        else:
+            d = crossmatch.sepn_deg(a[i,0],a[i,1],b[:,0],b[:,1])
+        pairs += [(i,j) for j in np.where(d<dist)[0]]
+    return sorted(pairs)
+
+def matched(a,b,dist,isabs):
+    c = crossmatch.correlate(a,0,1,b,0,1,dist,isabs=isabs,noisy=False)
+    return sorted((int(i),int(j)) for i,j,d in c) if len(c) else []
+
+# pairs just inside dist, many of them straddling a declination zone edge,
+# on coordinates offset far from zero
+
+@pytest.mark.parametrize('base',[0.0,1.e4,1.e6,-5.e5])
+@pytest.mark.parametrize('dist',[1.e-3,0.1,3.7])
+def test_isabs_edge_pairs(base,dist):
+    rng = np.random.RandomState(1)
+    a = base+rng.uniform(0,20,size=(200,2))*dist
+    th = rng.uniform(0,2*np.pi,len(a))
+    r = dist*(1.0-rng.choice([1.e-15,1.e-12,1.e-9,1.e-6],len(a)))
+    b = a+np.column_stack((r*np.cos(th),r*np.sin(th)))
+    b[::2,1] = np.round(b[::2,1]/dist)*dist
+    assert matched(a,b,dist,True) == brute(a,b,dist,True)
+
+def test_sky_pairs():
+    rng = np.random.RandomState(2)
+    a = np.column_stack((rng.uniform(-10,370,300),rng.uniform(-89.9,89.9,300)))
+    b = a+rng.normal(0,0.5,size=a.shape)
+    b[:,1] = b[:,1].clip(-90,90)
+    assert matched(a,b,0.5,False) == brute(a,b,0.5,False)
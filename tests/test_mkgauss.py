@@ -0,0 +1,26 @@
+import os,sys,numpy as np,pytest
+for module in ('pyrap.tables','astropy','scipy','matplotlib'):
+    pytest.importorskip(module)
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','bin'))
+import skynet_master as sm
+
+NAXES = [40,30]
+OFFGRID = [(-30.0,15.0),(20.0,-30.0),(80.0,15.0),(20.0,70.0),(-30.0,-30.0)]
+
+@pytest.mark.parametrize('pos',OFFGRID)
+def test_mkgauss_off_grid(pos):
+    for axrat,angle in ((1.0,0.0),(0.5,30.0)):
+        a = sm.mkgauss(NAXES,pos,1.0,3.0,axrat,angle)
+        assert a.shape == (NAXES[1],NAXES[0])
+        assert not a.any()
+
+def test_mkgauss_many_off_grid():
+    pos = np.array(OFFGRID+[(20.0,15.0)])
+    total = sm.mkgauss_many(NAXES,pos,1.0,3.0)
+    assert np.allclose(total,sm.mkgauss(NAXES,(20.0,15.0),1.0,3.0))
+    labels = sm.mkgauss_many(NAXES,pos,1.0,3.0,labels=np.nan*np.ones((NAXES[1],NAXES[0])))
+    assert set(np.unique(labels[np.isfinite(labels)])) == set([len(OFFGRID)])
+
+def test_mkgauss_partly_on_grid():
+    a = sm.mkgauss(NAXES,(-2.0,15.0),1.0,3.0)
+    assert a[:,0].max() > 0.0 and not a[:,10:].any()
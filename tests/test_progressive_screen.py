@@ -0,0 +1,64 @@
+import os,sys,numpy as np,pytest
+pytest.importorskip('pyrap.tables')
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','bin'))
+import evaluate_potential_delay_calibrators as epdc
+
+COORDS = ['10.0,50.0,a','10.1,50.1,b']
+
+def make_mslist(tmpdir,n):
+    mslist = []
+    for i in range(n):
+        ms = str(tmpdir.join('sb%03d.ms'%i))
+        os.mkdir(ms)
+        mslist.append(ms)
+    return mslist
+
+# shift_accumulate that finds no rows for the triangle in the subbands
+# listed in empty, and random (incoherent) data in the others
+
+def fake_accumulate(empty):
+    rng = np.random.RandomState(1)
+    def shift_accumulate(ms,radec,tel=None,datacol='DATA',tstep=8,acc=None):
+        if ms in empty:
+            return acc
+        v = np.exp(2j*np.pi*rng.uniform(size=(len(radec),3,50)))
+        if acc is None:
+            return {'t0':0.0,'dt':8.0,'vsum':v}
+        acc['vsum'] = acc['vsum']+v
+        return acc
+    return shift_accumulate
+
+def test_first_subband_without_rows(tmpdir,monkeypatch):
+    mslist = make_mslist(tmpdir,8)
+    order = [mslist[i] for i in epdc.spread_order(len(mslist))]
+    monkeypatch.setattr(epdc,'shift_accumulate',fake_accumulate(order[:1]))
+    scatter,nsbused = epdc.progressive_screen(mslist,COORDS,nstart=1)
+    assert np.all(np.isfinite(scatter))
+    assert np.all(nsbused >= 2)
+
+def test_no_subband_with_rows(tmpdir,monkeypatch):
+    mslist = make_mslist(tmpdir,8)
+    monkeypatch.setattr(epdc,'shift_accumulate',fake_accumulate(mslist))
+    scatter,nsbused = epdc.progressive_screen(mslist,COORDS,nstart=1)
+    assert np.all(np.isnan(scatter))
+    assert np.all(nsbused == 0)
+
+# shift_scatter giving the scatter of the active directions at each step
+
+def scripted_scatter(steps):
+    steps = list(steps)
+    def shift_scatter(acc):
+        s = np.array(steps.pop(0),dtype='float')
+        assert len(s) == len(acc['vsum'])
+        return s
+    return shift_scatter
+
+def test_weak_and_nan_directions_kept(tmpdir,monkeypatch):
+    mslist = make_mslist(tmpdir,8)
+    coords = ['%d.0,50.0,s%d'%(i,i) for i in range(4)]
+    monkeypatch.setattr(epdc,'shift_accumulate',fake_accumulate([]))
+    monkeypatch.setattr(epdc,'shift_scatter',scripted_scatter(\
+        [[1.28,1.52,1.64,np.nan],[0.17,0.37,1.0],[0.15,0.9]]))
+    scatter,nsbused = epdc.progressive_screen(mslist,coords,nstart=2)
+    assert np.allclose(scatter,[0.17,0.15,1.64,0.9])
+    assert list(nsbused) == [4,8,2,8]